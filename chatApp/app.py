@@ -5,6 +5,7 @@ from .log import logger
 from .parse import *
 from .server import Server
 from .client import Client
+from .host import ClientHost
 
 
 def main():
@@ -12,20 +13,29 @@ def main():
     mode = args[0]
 
     if mode == SERVER_MODE:
-        port = parse_server_args(args)
-        logger.info(f"server mode, args: {port}")
+        port, options = parse_server_args(args)
+        logger.info(f"server mode, args: {port}, options: {options}")
 
         # pass control to Server object
-        Server(port).start()
+        Server(port, **options).start()
     elif mode == CLIENT_MODE:
-        name, ip, sport, cport = parse_client_args(args)
-        logger.info(f"client mode, args: {name}, {ip}, {sport}, {cport}")
+        name, ip, sport, cport, options = parse_client_args(args)
+        logger.info(f"client mode, args: {name}, {ip}, {sport}, {cport}, "
+                    f"options: {options}")
 
         # pass control to Client object
-        Client(name, ip, sport, cport).start()
+        Client(name, ip, sport, cport, **options).start()
+    elif mode == HOST_MODE:
+        names, ip, sport, port, options = parse_host_args(args)
+        logger.info(f"client host mode, args: {names}, {ip}, {sport}, "
+                    f"{port}, options: {options}")
+
+        # pass control to ClientHost object
+        ClientHost(ip, sport, port, **options).start(names)
     else:
         logger.critical(
-            f"mode {mode} unrecognized: -s (server) or (-c) client")
+            f"mode {mode} unrecognized: -s (server), (-c) client or (-m) "
+            f"client host")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,503 @@
+#
+# Micro benchmarks for the chat protocol, run with:
+#
+#   python -m chatApp.bench <name> [args...]
+#
+
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from .message import *
+from .constant import BUF_SIZE, BATCH_SIZE
+from .history import History, CHANNEL
+from .cache import PeerCache
+from .egress import EgressSocket
+from .transport import bind, unix_addr, UNIX
+from .ratelimit import DEFAULT_LIMITS
+
+
+def timeit(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6  # microseconds per call
+
+
+def peer_table(n):
+    return {
+        f"user{i}": ["127.0.0.1", 10000 + i, i % 3 != 0]
+        for i in range(n)
+    }
+
+
+def offline_msgs(n):
+    return [[1648160000.0 + i, f"user{i % 7}", f"see you at {i} pm", i % 2]
+            for i in range(n)]
+
+
+def bench_compress(rounds=2000):
+    rounds = int(rounds)
+    samples = [(f"ACK_REG {n} peers", ACK_REG, json.dumps(peer_table(n)))
+               for n in (5, 20, 50)]
+    samples += [("PEERS_UPDATE", PEERS_UPDATE, json.dumps(peer_table(1)))]
+    samples += [(f"OFFLINE_MSG {n} msgs", OFFLINE_MSG,
+                 json.dumps(offline_msgs(n))) for n in (5, 20)]
+
+    print(f"{'message':<22}{'raw':>7}{'wire':>7}{'saved':>8}"
+          f"{'make us':>10}{'+zlib us':>10}{'parse us':>10}")
+
+    for name, typ, content in samples:
+        raw, _ = make(typ, content)
+        packed, _ = make(typ, content, compress=True)
+        saved = 100 * (len(raw) - len(packed)) / len(raw)
+
+        t_plain = timeit(lambda: make(typ, content), rounds)
+        t_zlib = timeit(lambda: make(typ, content, compress=True), rounds)
+        t_parse = timeit(lambda: parse(packed), rounds)
+
+        print(f"{name:<22}{len(raw):>7}{len(packed):>7}{saved:>7.1f}%"
+              f"{t_plain:>10.1f}{t_zlib:>10.1f}{t_parse:>10.1f}")
+
+
+def quiet_logger():
+    logger = logging.Logger("bench")
+    logger.setLevel(logging.WARNING)
+    return logger
+
+
+def run_server(port, options):
+    from .server import Server
+    Server(port, logger=quiet_logger(), **options).start()
+
+
+def start_server(port, **options):
+    server = multiprocessing.Process(target=run_server,
+                                     args=(port, options),
+                                     daemon=True)
+    server.start()
+    time.sleep(0.5)
+    return server
+
+
+def bench_pps(port=15000, duration=3, senders=4, batch=BATCH_SIZE):
+    # saturate the server with CHAT_MSG datagrams, which it acks, and
+    # count acks per second as the rate the server keeps up with
+    port, duration, senders = int(port), float(duration), int(senders)
+    server = start_server(port, batch=int(batch))
+
+    socks = []
+    for _ in range(senders):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        socks.append(sock)
+
+    packet, _ = make(CHAT_MSG, "x" * 64)
+    sent = acked = 0
+    end = time.perf_counter() + duration
+
+    while time.perf_counter() < end:
+        for sock in socks:
+            try:
+                sock.sendto(packet, ("127.0.0.1", port))
+                sent += 1
+            except BlockingIOError:
+                pass
+
+            while True:
+                try:
+                    sock.recv(BUF_SIZE)
+                    acked += 1
+                except BlockingIOError:
+                    break
+
+    server.terminate()
+    print(f"sent {sent / duration:.0f} pkt/s, "
+          f"server acked {acked / duration:.0f} pkt/s "
+          f"({100 * acked / max(sent, 1):.1f}%)")
+
+
+def bench_history(n=1000000, users=1000, queries=1000):
+    n, users, queries = int(n), int(users), int(queries)
+    rng = random.Random(0)
+    words = [f"word{i}" for i in range(5000)]
+    names = [f"user{i}" for i in range(users)]
+    history = History()
+
+    start = time.perf_counter()
+    for i in range(n):
+        src = rng.choice(names)
+        # one in ten messages goes to the channel
+        dest = CHANNEL if i % 10 == 0 else rng.choice(names)
+        text = " ".join(rng.choices(words, k=8))
+        history.add(1648160000.0 + i, src, dest, text)
+    elapsed = time.perf_counter() - start
+    print(f"indexed {n} messages in {elapsed:.1f}s "
+          f"({elapsed / n * 1e6:.1f} us/msg)")
+
+    pairs = [(rng.choice(names), rng.choice(names)) for _ in range(queries)]
+    lookups = [
+        ("last 50 with a peer", lambda u, p: history.conversation(u, p)),
+        ("last 50 of channel", lambda u, p: history.conversation(u, CHANNEL)),
+        ("search 1 term", lambda u, p: history.search(u, rng.choice(words))),
+        ("search 2 terms", lambda u, p: history.search(
+            u, " ".join(rng.choices(words, k=2)))),
+    ]
+
+    for name, query in lookups:
+        start = time.perf_counter()
+        for user, peer in pairs:
+            query(user, peer)
+        elapsed = (time.perf_counter() - start) / queries * 1e6
+        print(f"{name:<22}{elapsed:>10.1f} us")
+
+
+def bench_alloc(n=2000, fanout=20, size=200):
+    # memory allocated by the server per BROADCAST_MSG, from receiving the
+    # datagram to fanning it out: peak bytes while it is handled, and bytes
+    # still held after (history and retransmission records)
+    from .server import Server
+
+    n, fanout, size = int(n), int(fanout), int(size)
+    server = Server(0, logger=quiet_logger(), rate_limits={})
+    server.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.sock.bind(("127.0.0.1", 0))
+
+    # recipients all share a socket that is never read, sends to it are
+    # dropped once its buffer is full
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(("127.0.0.1", 0))
+
+    server.clients["sender"] = [*sender.getsockname(), True]
+    for i in range(fanout):
+        server.clients[f"user{i}"] = [*sink.getsockname(), True]
+
+    packet, _ = make(BROADCAST_MSG, "x" * size)
+    peak = held = 0
+
+    tracemalloc.start()
+    for _ in range(n):
+        sender.sendto(packet, server.sock.getsockname())
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+        server.handle_batch()
+
+        current, top = tracemalloc.get_traced_memory()
+        peak += top - before
+        held += current - before
+
+        # not part of the next message's allocations
+        server.inflight.clear()
+        for journal in server.journals:
+            journal.take()
+    tracemalloc.stop()
+
+    print(f"{n} broadcasts of {size} bytes to {fanout} clients: "
+          f"peak {peak / n:.0f} bytes, held {held / n:.0f} bytes per message")
+
+
+def start_client(name, port, cport, **options):
+    # a client without its stdin sender thread
+    from .client import Client
+
+    client = Client(name,
+                    "127.0.0.1",
+                    port,
+                    cport,
+                    logger=quiet_logger(),
+                    **options)
+    client.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.sock.bind(("127.0.0.1", cport))
+    client.register()
+
+    for target in (client.listen, client.timeout):
+        threading.Thread(target=target, daemon=True).start()
+    return client
+
+
+def bench_relay(port=16000, clients=50, k=4, rounds=20):
+    # a broadcast to clients, directly (k=0) then through relay trees of
+    # k relays: datagrams the server sends per broadcast, and time until
+    # the last client got it
+    port, clients, rounds = int(port), int(clients), int(rounds)
+
+    for run, relay in enumerate((0, int(k))):
+        # ports of the previous run may still be bound by its listeners
+        port += run * (clients + 1)
+        server = start_server(port, relay=relay)
+        received = dict()  # name -> [(time, from server)]
+
+        def counting(name, handler):
+            def handle(id, addr, message):
+                received[name].append((time.perf_counter(),
+                                       addr == ("127.0.0.1", port)))
+                handler(id, addr, message)
+            return handle
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            group = []
+            for i in range(clients):
+                client = start_client(f"user{i}", port, port + 1 + i)
+                received[client.username] = []
+                for typ in (BROADCAST_MSG, RELAY_MSG):
+                    client.handlers[typ] = counting(client.username,
+                                                    client.handlers[typ])
+                group.append(client)
+            time.sleep(2)
+
+            sends, latencies = 0, []
+            for _ in range(rounds):
+                for got in received.values():
+                    got.clear()
+
+                start = time.perf_counter()
+                group[0].send_all("x" * 64)
+                while time.perf_counter() - start < 5 and any(
+                        len(received[c.username]) == 0 for c in group[1:]):
+                    time.sleep(0.001)
+
+                latencies.append(max(received[c.username][0][0]
+                                     for c in group[1:]) - start)
+                time.sleep(0.2)
+                sends += sum(from_server for got in received.values()
+                             for _, from_server in got)
+
+            for client in group:
+                client.done = True
+                client.sock.close()
+
+        server.terminate()
+        server.join()
+        ms = [latency * 1000 for latency in latencies]
+        print(f"{'direct' if relay == 0 else f'relay k={relay}':<12}"
+              f"server sends {sends / rounds:>6.1f} per broadcast, "
+              f"last delivery p50 {percentile(ms, 50):.2f}ms "
+              f"max {max(ms):.2f}ms")
+
+
+def bench_lookup(users=100000, chats=100000, skew=1.1):
+    # hit rates of the client peer cache for chats to peers drawn with a
+    # Zipf-like skew, one chat per second, against the size of the full
+    # directory a client would be pushed otherwise
+    users, chats, skew = int(users), int(chats), float(skew)
+    rng = random.Random(0)
+    weights = [1 / (rank + 1)**skew for rank in range(users)]
+    peers = rng.choices(range(users), weights, k=chats)
+
+    directory = len(json.dumps(peer_table(users)))
+    print(f"full directory of {users} users: {directory / 1024:.0f} KiB")
+
+    for ttl in (60, 600, 3600):
+        for capacity in (16, 64, 256, 1024):
+            cache = PeerCache(capacity, ttl)
+            for now, peer in enumerate(peers):
+                name = f"user{peer}"
+                if cache.get(name, now) is None:
+                    cache.put(name, ["127.0.0.1", 10000, True], now)
+
+            print(f"ttl {ttl:>5}s capacity {capacity:>5}: hit rate "
+                  f"{100 * cache.hit_rate():5.1f}%, {cache.misses} lookups "
+                  f"({cache.expired} expired, {cache.evicted} evicted)")
+
+
+def bench_egress(bulk=2000, cost=50):
+    # a burst of bulk PEERS_UPDATE followed by one ACK_STATUS, to a
+    # receiver taking cost microseconds per datagram: how much of the burst
+    # gets through and how long the ack takes, sent inline and through the
+    # egress queue
+    bulk, cost = int(bulk), float(cost) / 1e6
+    update, _ = make(PEERS_UPDATE, json.dumps(peer_table(1)))
+    ack, _ = make(ACK_STATUS, json.dumps(True))
+
+    for egress in (False, True):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(1)
+        addr = receiver.getsockname()
+        got = []  # (time, type)
+
+        def drain():
+            while True:
+                try:
+                    data = receiver.recv(BUF_SIZE)
+                except socket.timeout:
+                    return
+                got.append((time.perf_counter(), parse(data)[0]))
+                time.sleep(cost)
+
+        drainer = threading.Thread(target=drain, daemon=True)
+        drainer.start()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if egress:
+            sock = EgressSocket(sock)
+
+        for _ in range(bulk):
+            sock.sendto(update, addr)
+        sent = time.perf_counter()
+        sock.sendto(ack, addr)
+
+        drainer.join()
+        sock.close()
+        receiver.close()
+
+        updates = sum(1 for _, typ in got if typ == PEERS_UPDATE)
+        acked = [ts for ts, typ in got if typ == ACK_STATUS]
+        ack_ms = f"{(acked[0] - sent) * 1000:.1f}ms" if acked else "lost"
+        print(f"{'egress' if egress else 'inline':<8}{updates:>6}/{bulk} "
+              f"updates received, ack after {ack_ms}")
+        if egress:
+            print(sock.report())
+
+
+def bench_host(port=17000, identities=100, standalone=100):
+    # identities registered through one client host, against standalone
+    # clients with their own socket, listener and timer: time to register
+    # them all, and threads, sockets and bytes allocated per identity.
+    # Thread stacks are not traced, only counted
+    from .host import ClientHost
+
+    port, identities, standalone = int(port), int(identities), int(standalone)
+    server = start_server(port)
+    # a host's identities register one at a time under the REGISTER limit
+    # of its address
+    rate, burst = DEFAULT_LIMITS[REGISTER]
+
+    def host(n):
+        host = ClientHost("127.0.0.1", port, 0, logger=quiet_logger())
+        host.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        host.sock.bind(("127.0.0.1", 0))
+        for target in (host.listen, host.timeout):
+            threading.Thread(target=target, daemon=True).start()
+        return [host.add(f"bot{i}") for i in range(n)], 1
+
+    def alone(n):
+        return [
+            start_client(f"user{i}", port, port + 1 + i, lookup=True)
+            for i in range(n)
+        ], n
+
+    for name, run, n in (("hosted", host, identities),
+                         ("standalone", alone, standalone)):
+        threads = threading.active_count()
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            group, sockets = run(n)
+            deadline = 10 + max(n - burst, 0) / rate
+            while time.perf_counter() - start < deadline and any(
+                    c.username not in c.peers for c in group):
+                time.sleep(0.001)
+
+        elapsed = time.perf_counter() - start
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        registered = sum(1 for c in group if c.username in c.peers)
+
+        print(f"{name:<12}{registered:>6}/{n} registered in {elapsed:.2f}s, "
+              f"{threading.active_count() - threads} threads, "
+              f"{sockets} sockets, {held / n:.0f} bytes per identity")
+
+    server.terminate()
+
+
+def bench_transport(port=18000, rounds=5000, duration=3, window=8, size=64):
+    # round trips of a CHAT_MSG to the server and its ack, one at a time,
+    # then acks per second keeping window requests in flight, over loopback
+    # UDP and over a Unix-domain socket
+    port, rounds, window = int(port), int(rounds), int(window)
+    duration, size = float(duration), int(size)
+    tmp = tempfile.mkdtemp()
+    packet, _ = make(CHAT_MSG, "x" * size)
+
+    for name, endpoint, cendpoint in (
+        ("udp", port, 0),
+        ("unix", f"{UNIX}{tmp}/server.sock", f"{UNIX}{tmp}/client.sock"),
+    ):
+        server = start_server(endpoint)
+        addr = unix_addr(endpoint) if name == "unix" else ("127.0.0.1", port)
+        sock = bind(cendpoint, "127.0.0.1")
+        sock.settimeout(1)
+
+        rtts = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            sock.sendto(packet, addr)
+            try:
+                sock.recvfrom(BUF_SIZE)
+            except socket.timeout:
+                continue
+            rtts.append((time.perf_counter() - start) * 1e6)
+
+        sock.settimeout(0.1)
+        acked = lost = inflight = 0
+        end = time.perf_counter() + duration
+
+        while time.perf_counter() < end:
+            # a send on a full Unix-domain queue is dropped, returning 0
+            while inflight < window and sock.sendto(packet, addr) > 0:
+                inflight += 1
+
+            try:
+                sock.recvfrom(BUF_SIZE)
+                acked += 1
+                inflight -= 1
+            except socket.timeout:
+                lost += inflight
+                inflight = 0
+
+        sock.close()
+        server.terminate()
+        server.join()
+        print(f"{name:<6}rtt p50 {percentile(rtts, 50):.1f}us "
+              f"p99 {percentile(rtts, 99):.1f}us ({rounds - len(rtts)} lost), "
+              f"window {window}: {acked / duration:.0f} acks/s "
+              f"({lost} lost)")
+
+    shutil.rmtree(tmp)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+benchmarks = {
+    "compress": bench_compress,
+    "pps": bench_pps,
+    "history": bench_history,
+    "alloc": bench_alloc,
+    "relay": bench_relay,
+    "lookup": bench_lookup,
+    "egress": bench_egress,
+    "host": bench_host,
+    "transport": bench_transport,
+}
+
+
+def main():
+    args = sys.argv[1:]
+
+    if len(args) == 0 or args[0] not in benchmarks:
+        print(f"Usage: python -m chatApp.bench <{'|'.join(benchmarks)}> ...")
+        sys.exit(1)
+
+    benchmarks[args[0]](*args[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#
+# Client-side cache of peers resolved with LOOKUP, bounded in size (least
+# recently used entries are evicted first) and in age (entries expire ttl
+# seconds after they were resolved)
+#
+
+from collections import OrderedDict
+
+from .message import get_monotonic
+from .constant import LOOKUP_CACHE_SIZE, LOOKUP_TTL
+
+
+class PeerCache:
+
+    def __init__(self, capacity=LOOKUP_CACHE_SIZE, ttl=LOOKUP_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()  # name -> (info, expiry)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.invalidated = 0
+
+    def get(self, name, now=None):
+        now = get_monotonic() if now is None else now
+
+        if name in self.entries:
+            info, expiry = self.entries[name]
+            if now < expiry:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return info
+
+            del self.entries[name]
+            self.expired += 1
+
+        self.misses += 1
+        return None
+
+    def put(self, name, info, now=None):
+        now = get_monotonic() if now is None else now
+
+        self.entries[name] = (info, now + self.ttl)
+        self.entries.move_to_end(name)
+
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def peek(self, name):
+        # info of a cached peer, expired or not, without counting a lookup
+        entry = self.entries.get(name)
+        return None if entry is None else entry[0]
+
+    def invalidate(self, name):
+        if self.entries.pop(name, None) is not None:
+            self.invalidated += 1
+
+    def find(self, addr):
+        # name of a cached peer at addr, expired or not
+        for name, ([ip, port, _], _) in self.entries.items():
+            if (ip, port) == tuple(addr):
+                return name
+        return None
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def __str__(self):
+        return (f"{len(self.entries)}/{self.capacity} peers cached, "
+                f"hit rate {100 * self.hit_rate():.1f}% ({self.hits} hits, "
+                f"{self.misses} misses of which {self.expired} expired), "
+                f"{self.evicted} evicted, {self.invalidated} invalidated")
@@ -0,0 +1,142 @@
+#
+# Incremental snapshots of server state to a local journal file
+#
+# Every line of the journal is a JSON list [table, key, value], value null
+# meaning the key was deleted. Replaying the journal in order gives the
+# latest state; the journal is compacted in place once it is mostly stale.
+#
+
+import gc
+import json
+import os
+import time
+
+from .message import *
+from .constant import CHECKPOINT_INTERVAL
+
+TABLES = ("clients", "msg_store", "inflight", "negotiated")
+
+
+def load(path):
+    state = {table: dict() for table in TABLES}
+
+    if not os.path.exists(path):
+        return state
+
+    # loading allocates millions of containers that are all kept alive,
+    # cyclic gc passes over them only slow the load down
+    gc.disable()
+
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    [table, key, value] = json.loads(line)
+                except ValueError:
+                    # torn write at the end of the journal
+                    break
+
+                if value is None:
+                    state[table].pop(key, None)
+                else:
+                    state[table][key] = value
+    finally:
+        gc.enable()
+
+    return state
+
+
+class Journal:
+    # tracks keys of server tables changed since the last take()
+
+    def __init__(self, server, tables=TABLES):
+        self.server = server
+        self.tables = tables
+        self.dirty = {table: set() for table in tables}
+
+    def mark(self, table, key):
+        # must be called with server.mu held
+        if table in self.dirty:
+            self.dirty[table].add(key)
+
+    def mark_all(self):
+        # must be called with server.mu held
+        for table in self.tables:
+            self.dirty[table].update(getattr(self.server, table))
+
+    def take(self):
+        # copy only what changed, so the lock is held for O(changes)
+        # rather than for the size of the state
+        self.server.mu.acquire()
+
+        dirty = self.dirty
+        self.dirty = {table: set() for table in self.tables}
+
+        changes = []
+        for table, keys in dirty.items():
+            data = getattr(self.server, table)
+            for key in keys:
+                value = data.get(key)
+                if type(value) == list:
+                    value = list(value)
+                changes.append((table, key, value))
+
+        self.server.mu.release()
+
+        return changes
+
+
+class Checkpointer(Journal):
+
+    def __init__(self, server, path, interval=CHECKPOINT_INTERVAL):
+        super().__init__(server)
+        self.path = path
+        self.interval = interval
+        # lines in the journal, and live keys as of the last compaction
+        self.lines = 0
+        self.live = 0
+
+    def flush(self):
+        changes = self.take()
+
+        if len(changes) == 0:
+            return
+
+        with open(self.path, "a") as f:
+            for change in changes:
+                f.write(json.dumps(change) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.lines += len(changes)
+
+        if self.lines > 2 * self.live + 1024:
+            self.compact()
+
+    def compact(self):
+        # only this thread writes the journal, so it can be folded and
+        # rewritten without blocking the server
+        start = time.time()
+        state = load(self.path)
+        tmp = f"{self.path}.tmp"
+
+        self.live = 0
+        with open(tmp, "w") as f:
+            for table, data in state.items():
+                for key, value in data.items():
+                    f.write(json.dumps([table, key, value]) + "\n")
+                    self.live += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, self.path)
+        self.lines = self.live
+
+        self.server.logger.info(
+            f"compacted checkpoint {self.path} to {self.live} records "
+            f"({int((time.time() - start) * 1000)}ms)")
+
+    def run(self):
+        while not self.server.done:
+            time.sleep(self.interval)
+            self.flush()
@@ -3,10 +3,16 @@ import re
 import socket
 import threading
 import time
+from collections import OrderedDict
 
 from .log import logger
 from .message import *
-from .constant import BUF_SIZE, TIMEOUT
+from .constant import BUF_SIZE, TIMEOUT, FAILOVER_AFTER
+from .trace import TracingSocket
+from .transport import bind
+from .egress import EgressSocket
+from .relay import split, wait, REPORTED_IDS
+from .cache import PeerCache
 
 
 class Client:
@@ -16,14 +22,52 @@ class Client:
                  server_ip,
                  server_port,
                  client_port,
-                 logger=logger):
+                 logger=logger,
+                 servers=None,
+                 copy_history=False,
+                 contacts=None,
+                 lookup=False,
+                 trace=None,
+                 egress=False,
+                 host=None):
         self.username = username
         self.server = server_ip
         self.sport = server_port
         self.port = client_port
         self.logger = logger
+        # servers to fail over to, in order, when the current one is down
+        self.servers = [(server_ip, server_port)] + (servers or [])
+        self.misses = 0  # consecutive timeouts of requests to the server
+        self.first_miss = None  # when the first of those was sent
+        self.failover_start = None
+        # send the server a copy of acked direct chats for its history
+        self.copy_history = copy_history
+        # users we get presence updates of, None for everyone
+        self.interests = None if contacts is None else set(contacts)
+        # without contacts, lookup registers for no peer table at all
+        if lookup and self.interests is None:
+            self.interests = set()
+        # the ClientHost this client is an identity of, if any. Its
+        # identities share its socket, lock and cache
+        self.host = host
+        # peers not in our table are resolved with LOOKUP when we chat
+        # with them, and cached
+        self.cache = PeerCache() if host is None else host.cache
+        self.lookups = dict()  # name -> chats waiting for it to resolve
+        # file to record every datagram sent or received to, if any
+        self.trace = trace
+        # send through a prioritized, paced queue instead of inline
+        self.egress = egress
+        # last history or search request and the cursor of its next page
+        self.query = None
+        self.cursor = None
         # dict of info of other clients (name, IP, port #, online status)
         self.peers = dict()
+        # broadcasts we relay: id -> (sender addr, names reached, ids of
+        # the relays we passed it to that haven't reported yet)
+        self.relays = dict()
+        self.relayed = dict()  # id of a relay we passed to -> broadcast id
+        self.reported = OrderedDict()  # ids of broadcasts reported lately
         self.handlers = {
             PEERS_UPDATE: self.update_peers,
             CHAT_MSG: self.handle_chat_msg,
@@ -36,36 +80,69 @@ class Client:
             OFFLINE_MSG: self.handle_offline_chat_msg,
             ACK_BROADCAST_MSG: self.handle_ack_broadcast_msg,
             BROADCAST_MSG: self.handle_broadcast_msg,
-            STATUS: self.handle_status
+            STATUS: self.handle_status,
+            THROTTLE: self.handle_throttle,
+            HISTORY_RESULT: self.handle_history_result,
+            RELAY_MSG: self.handle_relay_msg,
+            ACK_RELAY: self.handle_ack_relay,
+            ACK_WATCH: self.handle_ack_watch,
+            LOOKUP_RESULT: self.handle_lookup_result
         }
         self.timeout_handlers = {
             DEREGISTER: self.timeout_deregister,
             CHAT_MSG: self.timeout_chat,
             SAVE_MSG: self.timeout_save,
-            BROADCAST_MSG: self.timeout_broadcast_msg
+            BROADCAST_MSG: self.timeout_broadcast_msg,
+            HISTORY: self.timeout_query,
+            SEARCH: self.timeout_query,
+            RELAY_MSG: self.timeout_relay,
+            WATCH: self.timeout_query,
+            LOOKUP: self.timeout_lookup
         }
         self.inflight = dict()  # inflight messages/requests
-        self.mu = threading.Lock()  # mutext lock for self.inflight
+        # mutext lock for self.inflight
+        self.mu = threading.Lock() if host is None else host.mu
         self.done = False
 
         self.logger.info(
             f"instantiated client {self.username} @ port "
             f"{self.port} for server @ {self.server}:{self.sport}")
 
-    def find_user_by_addr(self, addr):
+    def find_user_by_addr(self, addr, id=None):
+        # the identities of a client host share its address, told apart by
+        # the names tagged on the id of their message or of ours they ack
+        for name in untag(id):
+            if name != self.username and self.addr_of(name) == tuple(addr):
+                return name
+
         user_ip, user_port = addr
         for name, [ip, port, _] in self.peers.items():
             if user_ip == ip and user_port == port:
                 return name
 
-        return None
-
-    def record(self, id, addr, typ, data, max_retry=-1, locked=False):
-        # max_retry = -1 -> can retry infinite times
+        return self.cache.find(addr)
+
+    def addr_of(self, name):
+        info = self.peers.get(name) or self.cache.peek(name)
+        return None if info is None else (info[0], info[1])
+
+    def new_id(self, to=""):
+        # id of a message we send to, the server if empty
+        return tag(msg_id(), self.username, to)
+
+    def record(self,
+               id,
+               addr,
+               typ,
+               data,
+               max_retry=-1,
+               locked=False,
+               wait=TIMEOUT):
+        # max_retry = -1 -> can retry infinite times, each after wait ms
         if not locked:
             self.mu.acquire()
 
-        ts = get_ts()
+        ts = get_ts() + (wait - TIMEOUT) / 1000
         self.inflight[id] = (ts, addr, typ, data, max_retry)
 
         if not locked:
@@ -90,8 +167,9 @@ class Client:
                  dest=None,
                  max_retry=-1,
                  id=None,
-                 locked=False):
-        encoded, id = make(typ, data, id)
+                 locked=False,
+                 to=""):
+        # to is the name of the peer at dest, if it is a tuple
         addr = None
 
         if type(dest) == tuple:
@@ -99,44 +177,103 @@ class Client:
         elif type(dest) == str:
             [ip, port, _] = self.peers[dest]
             addr = (ip, port)
+            to = dest
         else:
             addr = (self.server, self.sport)
 
-        self.sock.sendto(encoded, addr)
+        encoded, id = make(typ, data, id or self.new_id(to))
+
+        # record first, the reply may arrive before sendto returns
         self.record(id, addr, typ, data, max_retry, locked)
+        self.sock.sendto(encoded, addr)
 
     def send(self):
         while not self.done:
-            message = input('>>> ')
-
-            send = re.match(r"send (?P<name>.*?) (?P<msg>.*)$", message)
-            dereg = re.match(r"dereg (?P<name>.*?)$", message)
-            reg = re.match(r"reg (?P<name>.*?)$", message)
-            send_all = re.match(r"send_all (?P<msg>.*)$", message)
-
-            if send is not None:
-                self.send_chat(send.group('name'), send.group('msg'))
-            elif dereg is not None:
-                self.deregister(dereg.group('name'))
-            elif reg is not None:
-                self.register()
-            elif send_all is not None:
-                self.send_all(send_all.group('msg'))
-            elif message == "":
-                pass
-            else:
-                self.logger.error(f"unrecognized command: \"{message}\"")
+            self.command(input('>>> '))
+
+    def command(self, message):
+        send = re.match(r"send (?P<name>.*?) (?P<msg>.*)$", message)
+        dereg = re.match(r"dereg (?P<name>.*?)$", message)
+        reg = re.match(r"reg (?P<name>.*?)$", message)
+        send_all = re.match(r"send_all (?P<msg>.*)$", message)
+        history = re.match(r"history (?P<name>.*?)$", message)
+        search = re.match(r"search (?P<text>.*)$", message)
+        watch = re.match(r"(?P<cmd>un)?watch (?P<names>.*)$", message)
+
+        if send is not None:
+            self.send_chat(send.group('name'), send.group('msg'))
+        elif dereg is not None:
+            self.deregister(dereg.group('name'))
+        elif reg is not None:
+            self.register()
+        elif send_all is not None:
+            self.send_all(send_all.group('msg'))
+        elif history is not None:
+            self.history(HISTORY, history.group('name'))
+        elif search is not None:
+            self.history(SEARCH, search.group('text'))
+        elif watch is not None:
+            self.watch(set(watch.group('names').split()),
+                       watch.group('cmd') is None)
+        elif message == "cache":
+            print(f">>> [{self.cache}]")
+        elif message == "egress" and self.egress:
+            print(self.sock.report())
+        elif message == "more":
+            self.more()
+        elif message == "":
+            pass
+        else:
+            self.logger.error(f"unrecognized command: \"{message}\"")
 
     def send_chat(self, peer, msg):
-        if peer not in self.peers:
-            self.logger.error(f"can't send to {peer}, not in local table")
-        elif not self.peers[peer][2]:
+        info = self.peers.get(peer) or self.cache.get(peer)
+
+        if info is None:
+            self.lookup(peer, msg)
+        else:
+            self.deliver(peer, info, msg)
+
+    def deliver(self, peer, info, msg):
+        [ip, port, online] = info
+
+        if not online:
             # peer offline, send SAVE_MSG to server
             self.send_offline_chat(msg, peer)
         else:
-            self.udp_send(CHAT_MSG, msg, dest=peer, max_retry=0)
+            self.udp_send(CHAT_MSG, msg, dest=(ip, port), max_retry=0, to=peer)
             self.logger.info(f"{peer} online, sending: {shorten_msg(msg)}")
 
+    def lookup(self, peer, msg):
+        # resolve peer at the server, msg is sent once it is
+        self.mu.acquire()
+        if peer not in self.lookups:
+            self.lookups[peer] = []
+            self.udp_send(LOOKUP, peer, max_retry=2, locked=True)
+        self.lookups[peer].append(msg)
+        self.mu.release()
+
+    def handle_lookup_result(self, id, addr, message):
+        self.rm_record(id)
+        [peer, info] = json.loads(message)
+
+        self.mu.acquire()
+        msgs = self.lookups.pop(peer, [])
+        self.mu.release()
+
+        if info is None:
+            self.logger.error(f"can't send to {peer}, no such user")
+            return
+
+        self.cache.put(peer, info)
+        for msg in msgs:
+            self.deliver(peer, info, msg)
+
+    def timeout_lookup(self, id, addr, data):
+        # called with lock held
+        print(">>> [Server not responding.]")
+        self.lookups.pop(data, None)
+
     def send_offline_chat(self, msg, peer=None, lock=False):
         data = f"{peer} {msg}" if peer is not None else msg
         self.udp_send(SAVE_MSG, data, max_retry=0, locked=lock)
@@ -148,8 +285,39 @@ class Client:
         self.udp_send(BROADCAST_MSG, msg, max_retry=5)
         self.logger.info(f"sending {shorten_msg(msg)} to all")
 
+    def history(self, typ, arg, cursor=None):
+        # HISTORY with a peer ("*" for the channel) or SEARCH for terms
+        self.query = (typ, arg)
+        self.udp_send(typ, json.dumps([arg, cursor]), max_retry=2)
+
+    def more(self):
+        if self.query is None or self.cursor is None:
+            print(">>> [No more messages.]")
+        else:
+            self.history(*self.query, cursor=self.cursor)
+
+    def watch(self, names, add=True):
+        # add or remove names from our interest set, which starts from the
+        # peers we know if we didn't declare one
+        if self.interests is None:
+            self.interests = set(self.peers) - {self.username}
+
+        if add:
+            self.interests |= names
+        else:
+            self.interests -= names
+            for name in names - {self.username}:
+                self.peers.pop(name, None)
+
+        self.udp_send(WATCH, json.dumps(sorted(self.interests)), max_retry=2)
+
+    def handle_ack_watch(self, id, addr, message):
+        self.update_peers(id, addr, message)
+        self.rm_record(id)
+
     def update_peers(self, id, addr, message):
         for peer, info in json.loads(message).items():
+            self.cache.invalidate(peer)
             if peer not in self.peers:
                 self.peers[peer] = info
                 self.logger.info(f"added peer {peer}: {info} to local table")
@@ -162,7 +330,12 @@ class Client:
         print(">>> [Client table updated.]")
 
     def handle_chat_msg(self, id, addr, message):
-        peer = self.find_user_by_addr(addr)
+        peer = self.find_user_by_addr(addr, id)
+        if peer is None and self.interests is not None:
+            # our table only has the users we are interested in, the others
+            # would retry through the server forever if we didn't ack them
+            peer = f"{addr[0]}:{addr[1]}"
+
         if peer is not None:
             print(f">>> {peer}: {message}")
 
@@ -176,7 +349,7 @@ class Client:
             self.logger.info(f"received from unknown peer {addr}: {message}")
 
     def handle_ack_chat_msg(self, id, addr, message):
-        peer = self.find_user_by_addr(addr)
+        peer = self.find_user_by_addr(addr, id)
 
         if peer is not None:
             print(f">>> [Message received by {peer}.]")
@@ -184,6 +357,15 @@ class Client:
             self.logger.info(f"{addr} has gone offline, but message "
                              f"{shorten_msg(message)} received.")
 
+        if self.copy_history and peer is not None:
+            self.mu.acquire()
+            chat = self.inflight[id][3] if id in self.inflight else None
+            self.mu.release()
+
+            if chat is not None:
+                copy, _ = make(CHAT_COPY, f"{peer} {chat}", self.new_id())
+                self.sock.sendto(copy, (self.server, self.sport))
+
         self.rm_record(id)
 
     def handle_offline_chat_msg(self, id, addr, message):
@@ -203,13 +385,26 @@ class Client:
         print(">>> [Messages received by the server and saved]")
 
     def handle_nack_save(self, id, addr, message):
+        content = json.loads(message)
+
+        if type(content) == str:
+            # the server couldn't keep the message
+            print(f">>> [Message not saved: {content}.]")
+            self.rm_record(id)
+            return
+
         self.logger.info(
             f"SAVE_MSG {id} nacked by server, resend chat directly to peer.")
 
-        self.peers = json.loads(message)
+        self.peers = content
 
         # resend chat message directly to peer
         self.mu.acquire()
+        if id not in self.inflight:
+            # a duplicate, resent already
+            self.mu.release()
+            return
+
         data = self.inflight[id][3]
         peer, msg = data.split(" ", maxsplit=1)
         dest = (self.peers[peer][0], self.peers[peer][1])
@@ -219,7 +414,7 @@ class Client:
         print(">>> [Client table updated.]")
 
         self.rm_record(id)
-        self.udp_send(CHAT_MSG, msg, dest=dest, max_retry=0)
+        self.udp_send(CHAT_MSG, msg, dest=dest, max_retry=0, to=peer)
 
     def handle_ack_broadcast_msg(self, id, addr, message):
         print(">>> [Message received by Server.]")
@@ -230,9 +425,93 @@ class Client:
 
         print(f">>> [Channel_Message {src}: {msg} ].")
 
-        # ack server that we have recevied the channel message
+        # ack server that we have recevied the channel message, replying
+        # to the sender as a standby may have taken over the broadcast
         ack, _ = make(ACK_BROADCAST_MSG, id=id)
-        self.sock.sendto(ack, (self.server, self.sport))
+        self.sock.sendto(ack, addr)
+
+    def handle_relay_msg(self, id, addr, message):
+        [src, msg, tree, k] = json.loads(message)
+
+        # pass it on to the relays of our subtree, [name, ip, port] each
+        self.mu.acquire()
+        try:
+            if id in self.relays or id in self.reported:
+                # a duplicate, relayed already
+                return
+
+            print(f">>> [Channel_Message {src}: {msg} ].")
+            self.relays[id] = (addr, [self.username], set())
+
+            for [name, ip, port], rest in split(tree, k) if tree else []:
+                data = json.dumps([src, msg, rest, k])
+                dest = (ip, port)
+                resp, child = make(RELAY_MSG, data, self.new_id(name))
+
+                self.record(child,
+                            dest,
+                            RELAY_MSG,
+                            data,
+                            max_retry=0,
+                            locked=True,
+                            wait=wait(len(rest), k))
+                self.sock.sendto(resp, dest)
+
+                self.relays[id][2].add(child)
+                self.relayed[child] = id
+
+            self.report_relay(id)
+        finally:
+            self.mu.release()
+
+    def report_relay(self, id):
+        # called with lock held, reports who a relayed broadcast reached
+        # once all relays below us did or timed out
+        (addr, reached, pending) = self.relays[id]
+
+        if len(pending) == 0:
+            resp, _ = make(ACK_RELAY, json.dumps(reached), id=id)
+            self.sock.sendto(resp, addr)
+            del self.relays[id]
+
+            self.reported[id] = True
+            if len(self.reported) > REPORTED_IDS:
+                self.reported.popitem(last=False)
+
+    def handle_ack_relay(self, id, addr, message):
+        self.rm_record(id)
+
+        self.mu.acquire()
+        try:
+            parent = self.relayed.pop(id, None)
+            if parent in self.relays:
+                self.relays[parent][1].extend(json.loads(message))
+                self.relays[parent][2].discard(id)
+                self.report_relay(parent)
+        finally:
+            self.mu.release()
+
+    def timeout_relay(self, id, addr, data):
+        # called with lock held, the server delivers to that subtree
+        parent = self.relayed.pop(id, None)
+        if parent in self.relays:
+            self.relays[parent][2].discard(id)
+            self.report_relay(parent)
+
+    def handle_history_result(self, id, addr, message):
+        result = json.loads(message)
+        self.cursor = result["next"]
+
+        if len(result["msgs"]) == 0:
+            print(">>> [No messages.]")
+
+        for (_, timestamp, src, dest, msg) in result["msgs"]:
+            print(f">>> {src} -> {dest}: {timestamp} {msg}")
+
+        if self.cursor is not None:
+            print(">>> [Type \"more\" for older messages.]")
+
+        self.rm_record(id)
 
     def handle_ack_reg(self, id, addr, message):
         print(">>> [Welcome, You are registered.]")
@@ -259,10 +538,35 @@ class Client:
         resp, _ = make(ACK_STATUS, json.dumps(online), id=id)
         self.sock.sendto(resp, addr)
 
-    def register(self):
+    def handle_throttle(self, id, addr, message):
+        delay = int(message) / 1000
+
+        self.mu.acquire()
+
+        if id in self.inflight:
+            (ts, dest, typ, data, retries) = self.inflight[id]
+            # back off: push the timestamp forward so the timer resends
+            # the request after delay, keeping at least one retry for it
+            ts = get_ts() + delay - TIMEOUT / 1000
+            retries = retries if retries != 0 else 1
+            self.inflight[id] = (ts, dest, typ, data, retries)
+
+        self.mu.release()
+
+        print(f">>> [Server busy, retrying in {int(delay * 1000)}ms.]")
+        self.logger.info(f"request {id} throttled by server for {message}ms")
+
+    def register(self, locked=False):
         # register under self.username at the server
-        info = json.dumps([self.username, True])
-        self.udp_send(REGISTER, info)
+        # options offered to the server, it may ignore any of them
+        options = {"compress": "zlib"}
+        if self.interests is not None:
+            options["interests"] = sorted(self.interests)
+        if self.host is not None:
+            # our host tells its identities apart by the ids of messages
+            options["ids"] = "tagged"
+        info = json.dumps([self.username, True, options])
+        self.udp_send(REGISTER, info, locked=locked)
 
     def deregister(self, client):
         self.udp_send(DEREGISTER, client, max_retry=5)
@@ -273,7 +577,14 @@ class Client:
         self.stop()
 
     def timeout_chat(self, id, addr, data):
-        to_cli = self.find_user_by_addr(addr)
+        to_cli = self.find_user_by_addr(addr, id)
+        if to_cli is None:
+            # the peer left our table since, no one to save it for
+            print(f">>> [Message not delivered: {data}]")
+            return
+
+        # resolved again next time, it may have moved
+        self.cache.invalidate(to_cli)
         self.send_offline_chat(data, to_cli, lock=True)
 
     def timeout_save(self, id, addr, data):
@@ -284,31 +595,102 @@ class Client:
         print(">>> [Server not responding.]")
         self.rm_record(id)
 
+    def timeout_query(self, id, addr, data):
+        print(">>> [Server not responding.]")
+
+    def failover(self):
+        # called with lock held, returns False if there is nowhere to go
+        if len(self.servers) < 2:
+            return False
+
+        old = (self.server, self.sport)
+        i = self.servers.index(old) if old in self.servers else -1
+        self.server, self.sport = self.servers[(i + 1) % len(self.servers)]
+        self.misses = 0
+        self.first_miss = None
+
+        print(f">>> [Server not responding, failing over to "
+              f"{self.server}:{self.sport}]")
+        self.logger.info(f"server @ {old} down, failing over to "
+                         f"{self.server}:{self.sport}")
+
+        # resend pending server requests to the new server right away,
+        # giving exhausted ones a fresh set of retries
+        for id in list(self.inflight):
+            (ts, addr, typ, data, retries) = self.inflight[id]
+            if addr == old:
+                retries = retries if retries < 0 else max(
+                    retries, FAILOVER_AFTER)
+                self.udp_send(typ,
+                              data,
+                              max_retry=retries,
+                              id=id,
+                              locked=True)
+
+        # the standby knows us from replication, registering again marks
+        # us online there and gets us a fresh peer table
+        self.register(locked=True)
+
+        return True
+
     def listen(self):
+        # reused for every datagram, handlers only get the decoded content
+        buf = bytearray(BUF_SIZE)
+
         while not self.done:
-            resp, server_addr = self.sock.recvfrom(BUF_SIZE)
-            typ, id, data = parse(resp)
+            n, addr = self.sock.recvfrom_into(buf)
+            self.handle_datagram(buf, n, addr)
+
+    def handle_datagram(self, buf, n, server_addr):
+        typ, id, data = parse(buf, n)
 
-            print("")
-            self.handlers[typ](id, server_addr, data)
+        if server_addr == (self.server, self.sport):
+            self.misses = 0
+            self.first_miss = None
+
+            if self.failover_start is not None:
+                elapsed = int(get_ts() * 1000 - self.failover_start * 1000)
+                self.logger.info(
+                    f"server @ {self.server}:{self.sport} responding, "
+                    f"failed over in {elapsed}ms")
+                self.failover_start = None
+
+        print("")
+        self.handlers[typ](id, server_addr, data)
 
     def timeout(self):
         while not self.done:
-            now = get_ts()
-
-            self.mu.acquire()
+            self.check_timeouts(get_ts())
+            time.sleep(TIMEOUT / 1000)
 
+    def check_timeouts(self, now):
+        self.mu.acquire()
+        try:
             for id in list(self.inflight):
                 (ts, addr, typ, data, retries) = self.inflight[id]
                 has_timeout = timeout(ts, now)
 
+                if has_timeout and addr == (self.server, self.sport):
+                    self.misses += 1
+                    if self.first_miss is None:
+                        self.first_miss = ts
+
+                    # only misses in a row tell the server is down, a single
+                    # request timing out may just be slow to answer, like a
+                    # SAVE_MSG acked after the server probed the peer
+                    first_miss = self.first_miss
+
+                    if self.misses >= FAILOVER_AFTER and self.failover():
+                        if self.failover_start is None:
+                            self.failover_start = first_miss
+                        continue
+
                 if has_timeout and retries != 0:
                     # resend message
                     retries -= 1
                     retry_str = str(retries) if retries >= 0 else "inf"
-                    self.logger.info(
-                        f"Resending {id}, tries left after resend: {retry_str}"
-                    )
+                    self.logger.info(f"Resending {id}, tries left after "
+                                     f"resend: {retry_str}")
                     self.udp_send(typ,
                                   data,
                                   dest=addr,
@@ -316,28 +698,36 @@ class Client:
                                   id=id,
                                   locked=True)
                 elif has_timeout and retries == 0:
-                    self.logger.info(
-                        f"No retries left for {id}, dispatching timeout handler"
-                    )
+                    self.logger.info(f"No retries left for {id}, "
+                                     f"dispatching timeout handler")
                     print("")
                     self.timeout_handlers[typ](id, addr, data)
                     del self.inflight[id]
-
+        finally:
             self.mu.release()
 
-            time.sleep(TIMEOUT / 1000)
-
     def stop(self):
         self.done = True
+        if self.host is not None:
+            # the socket is the host's, only this identity leaves it
+            self.host.remove(self.username)
+            return
+
         self.sock.close()
         self.logger.info(f"client {self.username} gracefully exited")
         exit(0)
 
     def start(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind((socket.gethostname(), self.port))
+        self.sock = bind(self.port, socket.gethostname())
+
+        self.logger.info(f"created socket, bound to {self.port}")
+
+        if self.trace is not None:
+            self.sock = TracingSocket(self.sock, self.trace)
+            self.logger.info(f"recording datagrams to {self.trace}")
 
-        self.logger.info(f"created UDP socket, bound to port {self.port}")
+        if self.egress:
+            self.sock = EgressSocket(self.sock)
 
         self.register()
 
@@ -1,5 +1,41 @@
 SERVER_MODE = '-s'
 CLIENT_MODE = '-c'
+HOST_MODE = '-m'  # many client identities on one socket
 
 BUF_SIZE = 2048
+BATCH_SIZE = 32  # max datagrams the server drains per wake-up
+HISTORY_PAGE = 50  # max messages per page of history or search results
 TIMEOUT = 500  # 500 milliseonds
+CHECKPOINT_INTERVAL = 1  # seconds between server state snapshots
+
+# replication to standby servers
+REPL_INTERVAL = 0.05  # seconds between shipping batches of changes
+REPL_HEARTBEAT = 1  # seconds, an empty batch is shipped if idle this long
+REPL_RETRIES = 5  # resends of a batch before giving up on a standby
+REPL_SILENCE = 3  # seconds without batches before a standby resubscribes
+FAILOVER_AFTER = 5  # consecutive server timeouts before a client fails over
+
+# federation of servers
+FEDERATION_INTERVAL = 0.05  # seconds between announcing changed users
+NODE_RETRIES = 5  # resends of a message to another node before giving up
+
+# payloads at least this large are deflated for peers that negotiated it
+COMPRESS_THRESHOLD = 256  # bytes
+
+PROFILE_INTERVAL = 0.005  # seconds between stack samples while profiling
+
+# client-side cache of peers resolved on demand
+LOOKUP_CACHE_SIZE = 256  # peers
+LOOKUP_TTL = 60  # seconds a resolved peer is trusted
+
+# offline messages kept by the server
+STORE_MAX_MSGS = 100  # messages queued per recipient
+STORE_MAX_BYTES = 64 * 1024  # bytes queued per recipient
+STORE_BUDGET = 64 * 1024 * 1024  # bytes queued for all recipients
+STORE_TTL = 7 * 24 * 3600  # seconds a message is kept
+SWEEP_BATCH = 1000  # max messages expired per timer tick
+
+# egress scheduling, pacing each destination
+EGRESS_RATE = 5000  # datagrams per second to a destination
+EGRESS_BURST = 64  # datagrams sent to a destination back to back
+EGRESS_QUEUE = 1024  # datagrams of a class queued for a destination
@@ -0,0 +1,190 @@
+#
+# Egress scheduling: datagrams handed to the socket are queued per
+# destination and class and sent by one thread, control messages and acks
+# first, then chats, then bulk (presence updates, broadcast fan-out,
+# replication and federation)
+#
+# Each destination is paced by a token bucket so that a burst doesn't
+# overrun its receive buffer. Destinations with datagrams of a class
+# queued take turns, so one slow destination doesn't hold up the others.
+# At most EGRESS_QUEUE datagrams of a class are queued for a destination,
+# the ones sent meanwhile are dropped and counted, so a backlog of bulk
+# doesn't get acks dropped.
+#
+
+import time
+from collections import deque
+from threading import Thread, Condition
+
+from .message import *
+from .ratelimit import TokenBucket
+from .profiler import Stat
+from .constant import EGRESS_RATE, EGRESS_BURST, EGRESS_QUEUE
+
+CONTROL = 0
+CHAT = 1
+BULK = 2
+CLASSES = ("control", "chat", "bulk")
+
+CHAT_TYPES = (CHAT_MSG, SAVE_MSG, OFFLINE_MSG, FWD_SAVE, CHAT_COPY, HISTORY,
+              SEARCH, HISTORY_RESULT, LOOKUP)
+BULK_TYPES = (PEERS_UPDATE, BROADCAST_MSG, RELAY_MSG, REPL_LOG, NODE_SYNC,
+              NODE_UPDATE, NODE_BROADCAST)
+
+
+def classify(header):
+    # class of a datagram from its type field, compressed or not
+    typ = int(header[:header.find(delim.encode())].rstrip(b"z"))
+
+    if typ in BULK_TYPES:
+        return BULK
+    if typ in CHAT_TYPES:
+        return CHAT
+    return CONTROL
+
+
+class EgressSocket:
+    # wraps a socket, queueing what is sent on it for the sender thread
+
+    def __init__(self,
+                 sock,
+                 rate=EGRESS_RATE,
+                 burst=EGRESS_BURST,
+                 limit=EGRESS_QUEUE):
+        self.sock = sock
+        self.rate = rate  # datagrams per second to each destination
+        self.burst = burst
+        self.limit = limit  # datagrams queued per destination and class
+        self.queues = dict()  # addr -> a deque per class
+        self.ready = [deque() for _ in CLASSES]  # addrs with queued, per class
+        self.buckets = dict()  # addr -> TokenBucket
+        self.delays = [Stat() for _ in CLASSES]  # seconds queued
+        self.queued = 0
+        self.dropped = 0
+        self.cond = Condition()
+        self.done = False
+
+        Thread(target=self.run, name="egress", daemon=True).start()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def enqueue(self, data, addr):
+        cls = classify(data)
+
+        self.cond.acquire()
+        if addr not in self.queues:
+            self.queues[addr] = [deque() for _ in CLASSES]
+
+        queue = self.queues[addr][cls]
+        if len(queue) >= self.limit:
+            self.dropped += 1
+            self.cond.release()
+            return
+
+        if len(queue) == 0:
+            self.ready[cls].append(addr)
+        queue.append((time.perf_counter(), data))
+        self.queued += 1
+
+        self.cond.notify()
+        self.cond.release()
+
+    def sendto(self, data, addr):
+        self.enqueue(bytes(data), addr)
+        return len(data)
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        # copied, buffers may be views of a receive buffer that is reused
+        # before the datagram is sent
+        data = b"".join(buffers)
+        self.enqueue(data, addr)
+        return len(data)
+
+    def next(self, now):
+        # called with cond held, the next datagram to send as (class,
+        # queued at, datagram, addr), or the seconds until one can be sent
+        soonest = None
+
+        for cls, ready in enumerate(self.ready):
+            for _ in range(len(ready)):
+                addr = ready[0]
+                if addr not in self.buckets:
+                    self.buckets[addr] = TokenBucket(self.rate, self.burst,
+                                                     now)
+                bucket = self.buckets[addr]
+
+                if bucket.take(now):
+                    queue = self.queues[addr][cls]
+                    queued_at, item = queue.popleft()
+                    # round robin over the destinations of the class
+                    ready.popleft()
+                    if len(queue) > 0:
+                        ready.append(addr)
+                    elif not any(self.queues[addr]):
+                        del self.queues[addr]
+
+                    self.queued -= 1
+                    return cls, queued_at, item, addr
+
+                wait = (1 - bucket.tokens) / self.rate
+                soonest = wait if soonest is None else min(soonest, wait)
+                ready.rotate(-1)
+
+        return soonest
+
+    def prune(self, now):
+        # called with cond held, forgets idle destinations once their
+        # bucket is full again
+        for addr in list(self.buckets):
+            bucket = self.buckets[addr]
+            bucket.refill(now)
+            if addr not in self.queues and bucket.tokens >= self.burst:
+                del self.buckets[addr]
+
+    def run(self):
+        pruned = time.perf_counter()
+
+        while not self.done:
+            self.cond.acquire()
+            now = time.perf_counter()
+            item = self.next(now)
+
+            if now - pruned > 1:
+                self.prune(now)
+                pruned = now
+
+            if type(item) != tuple:
+                # nothing queued, or every destination with some is paced
+                self.cond.wait(timeout=item)
+                self.cond.release()
+                continue
+
+            cls, queued_at, data, addr = item
+            self.delays[cls].add(now - queued_at)
+            self.cond.release()
+
+            try:
+                self.sock.sendto(data, addr)
+            except OSError:
+                # closed, or the destination is unreachable
+                pass
+
+    def report(self):
+        self.cond.acquire()
+        lines = [f"{'egress queue delay':<32}{'count':>10}{'total ms':>12}"
+                 f"{'avg us':>12}{'max us':>12}"]
+        lines += [f"{name:<32}{stat}"
+                  for name, stat in zip(CLASSES, self.delays)]
+        lines += [f"{self.queued} datagrams queued for "
+                  f"{len(self.queues)} destinations, {self.dropped} dropped "
+                  f"(queue full)"]
+        self.cond.release()
+        return "\n".join(lines)
+
+    def close(self):
+        self.done = True
+        self.cond.acquire()
+        self.cond.notify()
+        self.cond.release()
+        self.sock.close()
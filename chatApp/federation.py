@@ -0,0 +1,212 @@
+#
+# Federation of independent servers (nodes), each owning its own users
+#
+# Nodes announce changes to their users to every other node as coalesced
+# NODE_UPDATE batches of [table, name, [ip, port, online]] entries, shipped
+# at most every FEDERATION_INTERVAL. A node that starts asks every other
+# node for a full summary with NODE_SYNC. SAVE_MSG for a user of another node is
+# forwarded to the owner as FWD_SAVE, and a broadcast is forwarded once per
+# node as NODE_BROADCAST. Node to node messages are acked with ACK_NODE and
+# resent with the same id, so receivers drop duplicates by id. Node
+# messages from addresses other than the nodes configured are dropped.
+#
+
+import json
+import time
+from collections import OrderedDict
+
+from .message import *
+from .checkpoint import Journal
+from .replicate import pack
+from .history import CHANNEL
+from .transport import resolve
+from .constant import FEDERATION_INTERVAL, NODE_RETRIES
+
+# ids of recently handled node messages kept for duplicate detection
+SEEN_IDS = 4096
+
+
+class Federation(Journal):
+
+    def __init__(self, server, nodes, interval=FEDERATION_INTERVAL):
+        super().__init__(server, ("clients", ))
+        # as their datagrams come from
+        self.nodes = list(map(resolve, nodes))
+        self.interval = interval
+        # users of other nodes: name -> (node addr, [ip, port, online], ts)
+        self.remote = dict()
+        self.synced = set()  # nodes we have a full summary from
+        self.syncing = set()  # nodes we asked for one
+        self.attempts = dict()  # id -> (message type, sends so far)
+        self.seen = OrderedDict()
+
+    def mark(self, table, key):
+        if len(self.nodes) > 0:
+            super().mark(table, key)
+
+    def known(self, node, typ):
+        # whether node is one we federate with, anyone else could claim
+        # our users or have us send on their behalf
+        if node in self.nodes:
+            return True
+
+        self.server.logger.info(
+            f"{msg_type(typ)} from {node}, not a node of ours, dropped")
+        return False
+
+    def owner(self, name):
+        # node owning a user of another node, None if unknown
+        return self.remote[name][0] if name in self.remote else None
+
+    def directory(self, names=None):
+        # users known to this node (all unless names are given), for the
+        # peer tables of our clients
+        if names is not None:
+            return {
+                name: self.server.clients.get(name) or self.remote[name][1]
+                for name in sorted(names)
+                if name in self.server.clients or name in self.remote
+            }
+
+        users = {name: info for name, (_, info, _) in self.remote.items()}
+        users.update(self.server.clients)
+        return users
+
+    def send(self, typ, data, node, id=None):
+        # called with lock held
+        resp, id = make(typ, data, id=id, compress=True)
+        self.server.sock.sendto(resp, node)
+        self.server.record(id, node, typ, data)
+        self.attempts[id] = (typ, self.attempts.get(id, (typ, 0))[1] + 1)
+
+    def resend(self, id, node, data):
+        # called with lock held, when a node message wasn't acked in time
+        typ, sent = self.attempts[id]
+
+        if sent > NODE_RETRIES:
+            self.server.logger.info(f"node @ {node} not responding, "
+                                    f"dropping {id}")
+            del self.attempts[id]
+            self.synced.discard(node)
+            self.syncing.discard(node)
+        else:
+            self.send(typ, data, node, id=id)
+
+    def ack(self, id):
+        # called with lock held
+        self.attempts.pop(id, None)
+        self.server.rm_record(id)
+
+    def duplicate(self, id, node):
+        # called with lock held, acks a node message and tells whether it
+        # was already handled
+        resp, _ = make(ACK_NODE, id=id)
+        self.server.sock.sendto(resp, node)
+
+        if id in self.seen:
+            return True
+
+        self.seen[id] = True
+        if len(self.seen) > SEEN_IDS:
+            self.seen.popitem(last=False)
+
+        return False
+
+    def announce(self, changes, node=None):
+        # called with lock held, send [table, name, info] changes to one
+        # node or all of them
+        nodes = self.nodes if node is None else [node]
+        ts = get_ts()
+
+        for batch in pack(changes):
+            for node in nodes:
+                self.send(NODE_UPDATE, json.dumps([ts, batch]), node)
+
+    def sync(self):
+        # called with lock held, ask nodes we have no summary from for one
+        for node in self.nodes:
+            if node not in self.synced and node not in self.syncing:
+                self.syncing.add(node)
+                self.send(NODE_SYNC, "", node)
+
+    def handle_sync(self, id, node, info):
+        if not self.known(node, NODE_SYNC) or self.duplicate(id, node):
+            return
+
+        changes = [("clients", name, info)
+                   for name, info in self.server.clients.items()]
+        self.announce(changes, node)
+        self.server.logger.info(
+            f"sent summary of {len(changes)} users to node @ {node}")
+
+        # a node that (re)started may have users we don't know about yet,
+        # ask it back unless this already is the answer to our request
+        if info != "back" and node not in self.syncing:
+            self.syncing.add(node)
+            self.send(NODE_SYNC, "back", node)
+
+    def handle_update(self, id, node, info):
+        if not self.known(node, NODE_UPDATE) or self.duplicate(id, node):
+            return
+
+        self.synced.add(node)
+        self.syncing.discard(node)
+        [ts, entries] = json.loads(info)
+
+        updates = dict()
+        for [_, name, info] in entries:
+            # batches may arrive out of order, keep the newest info
+            if name in self.remote and self.remote[name][2] > ts:
+                continue
+            self.remote[name] = (node, info, ts)
+            updates[name] = info
+
+        self.server.logger.info(
+            f"{len(updates)} users updated by node @ {node}")
+
+        # one table update per batch for each of our clients
+        if len(updates) > 0:
+            self.server.broadcast_peers(updates)
+
+    def forward_save(self, src, dest, id, to, msg):
+        # called with lock held, SAVE_MSG from our client src @ dest for
+        # a user of another node
+        data = json.dumps([src, list(dest), id, to, msg])
+        self.send(FWD_SAVE, data, self.owner(to))
+        self.server.logger.info(
+            f"forwarded SAVE_MSG {id} for {to} to node @ {self.owner(to)}")
+
+    def handle_forward_save(self, id, node, info):
+        if not self.known(node, FWD_SAVE) or self.duplicate(id, node):
+            return
+
+        [src, dest, save_id, to, msg] = json.loads(info)
+        self.server.save_for(src, tuple(dest), save_id, to, msg)
+
+    def forward_broadcast(self, src, chat):
+        # called with lock held
+        for node in self.nodes:
+            self.send(NODE_BROADCAST, f"{src} {chat}", node)
+
+    def handle_broadcast(self, id, node, info):
+        if not self.known(node, NODE_BROADCAST) or self.duplicate(id, node):
+            return
+
+        [src, chat] = info.split(" ", maxsplit=1)
+        self.server.history.add(get_ts(), src, CHANNEL, chat)
+
+        self.server.fan_out(src, chat)
+
+    def ship(self):
+        changes = self.take()
+
+        self.server.mu.acquire()
+        self.sync()
+        if len(changes) > 0:
+            self.announce(changes)
+        self.server.mu.release()
+
+    def run(self):
+        while not self.server.done:
+            time.sleep(self.interval)
+            self.ship()
@@ -0,0 +1,109 @@
+#
+# Server-side message history with a per-conversation time index and an
+# inverted term index, both paged with a message id cursor
+#
+# Message ids are positions in an append-only list, so they increase with
+# arrival time and every index is a sorted list of ids that can be bisected.
+# Channel messages belong to the conversation CHANNEL, which every user can
+# read. Terms are indexed per participant so a search only ever walks the
+# postings a user is allowed to see.
+#
+
+import re
+from bisect import bisect_left
+
+from .constant import HISTORY_PAGE
+
+CHANNEL = "*"
+
+
+def tokenize(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def conversation(a, b):
+    return CHANNEL if CHANNEL in (a, b) else tuple(sorted((a, b)))
+
+
+def before(ids, cursor):
+    # index in the sorted ids of the first id not before the cursor
+    return len(ids) if cursor is None else bisect_left(ids, cursor)
+
+
+class History:
+
+    def __init__(self):
+        self.msgs = []  # id -> (ts, src, dest, text)
+        self.convs = dict()  # conversation -> ids
+        self.postings = dict()  # (participant, term) -> ids
+
+    def add(self, ts, src, dest, text):
+        id = len(self.msgs)
+        self.msgs.append((ts, src, dest, text))
+        self.convs.setdefault(conversation(src, dest), []).append(id)
+
+        participants = {CHANNEL} if dest == CHANNEL else {src, dest}
+        for term in tokenize(text):
+            for participant in participants:
+                self.postings.setdefault((participant, term), []).append(id)
+
+    def entries(self, ids):
+        return [[id, *self.msgs[id]] for id in ids]
+
+    # Both queries return up to limit messages before the cursor as
+    # [id, ts, src, dest, text], oldest first, and the cursor of the next
+    # (older) page, None if there is none.
+
+    def conversation(self, user, peer, cursor=None, limit=HISTORY_PAGE):
+        ids = self.convs.get(conversation(user, peer), [])
+        end = before(ids, cursor)
+        page = ids[max(end - limit, 0):end]
+
+        return self.entries(page), page[0] if end > limit else None
+
+    def visible(self, user, term):
+        # sorted ids with the term that user may read
+        return [self.postings.get((user, term), []),
+                self.postings.get((CHANNEL, term), [])]
+
+    def search(self, user, text, cursor=None, limit=HISTORY_PAGE):
+        terms = tokenize(text)
+        if len(terms) == 0:
+            return [], None
+
+        lists = {term: self.visible(user, term) for term in terms}
+        # walk the rarest term, probe the others by bisection
+        rarest = min(terms, key=lambda t: sum(map(len, lists[t])))
+        others = [lists[t] for t in terms if t != rarest]
+
+        def contains(postings, id):
+            for ids in postings:
+                i = bisect_left(ids, id)
+                if i < len(ids) and ids[i] == id:
+                    return True
+            return False
+
+        found = []
+        heads = [before(ids, cursor) - 1 for ids in lists[rarest]]
+        more = False
+
+        while True:
+            # next id, newest first, merged from the user's and the
+            # channel's postings
+            candidates = [(ids[i], k)
+                          for k, (ids, i) in enumerate(zip(lists[rarest], heads))
+                          if i >= 0]
+            if len(candidates) == 0:
+                break
+
+            id, k = max(candidates)
+            heads[k] -= 1
+
+            if all(contains(postings, id) for postings in others):
+                if len(found) == limit:
+                    more = True
+                    break
+                found.append(id)
+
+        found.reverse()
+        return self.entries(found), found[0] if more else None
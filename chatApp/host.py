@@ -0,0 +1,216 @@
+#
+# A client host runs many client identities (bots, gateways) over one
+# socket: one listener routes every datagram to the identity it is for, one
+# timer checks the timeouts of all of them, and they share a lock and a
+# cache of looked-up peers
+#
+# Identities sharing an address are told apart by the names tagged on
+# message ids (see TAG in message.py). Replies go to the identity that sent
+# what they reply to, anything else to the identity it was sent to.
+#
+# Identities register one at a time: until the server knows a name as one
+# of ours, its REGISTER is rate limited by our address, and sending them
+# all at once would get most dropped and resent over and over.
+#
+
+import socket
+import threading
+import time
+from collections import deque
+
+from .log import logger
+from .message import *
+from .constant import BUF_SIZE, TIMEOUT
+from .client import Client
+from .cache import PeerCache
+from .trace import TracingSocket
+from .transport import bind
+from .egress import EgressSocket
+
+# messages echoing the id of one an identity sent
+REPLIES = (ACK_REG, NACK_REG, ACK_DEREG, NACK_DEREG, ACK_CHAT_MSG,
+           ACK_SAVE_MSG, NACK_SAVE_MSG, ACK_BROADCAST_MSG, THROTTLE,
+           HISTORY_RESULT, ACK_RELAY, ACK_WATCH, LOOKUP_RESULT)
+
+
+class ClientHost:
+
+    def __init__(self,
+                 server_ip,
+                 server_port,
+                 port,
+                 logger=logger,
+                 trace=None,
+                 egress=False,
+                 **options):
+        self.server = server_ip
+        self.sport = server_port
+        self.port = port
+        self.logger = logger
+        self.trace = trace
+        self.egress = egress
+        # for every identity, they get no peer table but their contacts
+        self.options = {"lookup": True, **options}
+        self.identities = dict()  # name -> Client
+        # identities waiting to register, and the one whose REGISTER is in
+        # flight
+        self.waiting = deque()
+        self.registering = None
+        self.cache = PeerCache()
+        self.mu = threading.Lock()
+        self.dropped = 0  # datagrams for no identity of ours
+        self.done = False
+
+    def add(self, name):
+        # a new identity, registered with the server once the ones added
+        # before it are
+        client = Client(name,
+                        self.server,
+                        self.sport,
+                        self.port,
+                        logger=self.logger,
+                        host=self,
+                        **self.options)
+        client.sock = self.sock
+
+        self.mu.acquire()
+        try:
+            self.identities[name] = client
+            self.waiting.append(client)
+            self.register_next()
+        finally:
+            self.mu.release()
+
+        return client
+
+    def register_next(self):
+        # called with lock held, registers the next identity waiting once
+        # the REGISTER in flight was answered or its identity left. One
+        # the server throttled keeps its turn until it is resent
+        client = self.registering
+        if client is not None and not client.done and \
+                self.identities.get(client.username) is client and \
+                any(typ == REGISTER for (_, _, typ, _, _) in
+                    client.inflight.values()):
+            return
+
+        self.registering = None
+        while len(self.waiting) > 0:
+            client = self.waiting.popleft()
+            if self.identities.get(client.username) is client:
+                self.registering = client
+                client.register(locked=True)
+                return
+
+    def remove(self, name):
+        # may be called with lock held, by the timer
+        self.identities.pop(name, None)
+        self.logger.info(f"identity {name} left the host")
+
+    def route(self, typ, id):
+        # the identity a datagram is for, None if not ours
+        names = untag(id)
+        if len(names) == 0:
+            return None
+
+        src, dest = names
+        return self.identities.get(src if typ in REPLIES else dest)
+
+    def listen(self):
+        buf = bytearray(BUF_SIZE)
+
+        while not self.done:
+            n, addr = self.sock.recvfrom_into(buf)
+            typ, id, _ = parse_header(buf, n)
+            client = self.route(typ, id)
+
+            if client is None:
+                self.dropped += 1
+                self.logger.info(f"{msg_type(typ)} {id} from {addr} is for "
+                                 f"no identity here, dropped")
+                continue
+
+            client.handle_datagram(buf, n, addr)
+
+            if typ in (ACK_REG, NACK_REG):
+                self.mu.acquire()
+                try:
+                    self.register_next()
+                finally:
+                    self.mu.release()
+
+    def timeout(self):
+        # one timer for every identity
+        while not self.done:
+            now = get_ts()
+            for client in list(self.identities.values()):
+                client.check_timeouts(now)
+
+            # the identity registering may have left
+            self.mu.acquire()
+            try:
+                self.register_next()
+            finally:
+                self.mu.release()
+
+            time.sleep(TIMEOUT / 1000)
+
+    def send(self):
+        # "<name> <command>" runs a client command as identity name, and
+        # "add <name>" adds one
+        while not self.done:
+            message = input('>>> ')
+            [name, _, command] = message.partition(" ")
+
+            if name == "add" and command != "":
+                self.add(command)
+            elif name == "egress" and self.egress:
+                print(self.sock.report())
+            elif name in self.identities:
+                self.identities[name].command(command)
+            elif message != "":
+                self.logger.error(f"no identity {name}: \"{message}\"")
+
+    def stop(self):
+        self.done = True
+        self.sock.close()
+        self.logger.info(
+            f"client host of {len(self.identities)} identities exited")
+
+    def start(self, names):
+        self.sock = bind(self.port, socket.gethostname())
+
+        self.logger.info(f"created socket, bound to {self.port}")
+
+        if self.trace is not None:
+            self.sock = TracingSocket(self.sock, self.trace)
+            self.logger.info(f"recording datagrams to {self.trace}")
+
+        if self.egress:
+            self.sock = EgressSocket(self.sock)
+
+        for name in names:
+            self.add(name)
+
+        listener = threading.Thread(target=self.listen,
+                                    name="host-listener",
+                                    daemon=True)
+        sender = threading.Thread(target=self.send,
+                                  name="host-sender",
+                                  daemon=True)
+        timer = threading.Thread(target=self.timeout,
+                                 name="host-timer",
+                                 daemon=True)
+
+        listener.start()
+        sender.start()
+        timer.start()
+
+        try:
+            timer.join()
+            sender.join()
+            listener.join()
+        except KeyboardInterrupt:
+            self.logger.info("keyboard interrupt! exiting client host...")
+        finally:
+            self.stop()
@@ -3,9 +3,11 @@
 #
 
 from datetime import datetime
+import time
 import uuid
+import zlib
 
-from .constant import TIMEOUT
+from .constant import TIMEOUT, COMPRESS_THRESHOLD
 
 # A Message can be one of these types
 CHAT_MSG = 0
@@ -25,22 +27,78 @@ BROADCAST_MSG = 13
 ACK_BROADCAST_MSG = 14
 STATUS = 15
 ACK_STATUS = 16
+THROTTLE = 17
+REPL_SUBSCRIBE = 18
+REPL_LOG = 19
+ACK_REPL = 20
+NODE_SYNC = 21
+NODE_UPDATE = 22
+NODE_BROADCAST = 23
+FWD_SAVE = 24
+ACK_NODE = 25
+CHAT_COPY = 26
+HISTORY = 27
+SEARCH = 28
+HISTORY_RESULT = 29
+RELAY_MSG = 30
+ACK_RELAY = 31
+WATCH = 32
+ACK_WATCH = 33
+LOOKUP = 34
+LOOKUP_RESULT = 35
 
 delim = " "
 
+# ids of messages between clients, or to clients of a client host, are
+# tagged with the names of the sender and the recipient, "<id>~<from>~<to>",
+# where the server's name is empty. The identities of a client host share
+# its address, so these tell them apart
+TAG = "~"
+
+# appended to the type field of a message whose content is deflated
+COMPRESSED = "z"
+
+# Preset dictionary for deflate, primed with the shape of the bulk messages
+# (peer tables, offline message lists). zlib favours the end of the
+# dictionary, so the most common substrings come last.
+ZDICT = (
+    '[[1648160000.000000, "", "", 0], [1648160000.000000, "", "", 1]] '
+    '"192.168.0.1", 10000, "10.0.0.1", 20000, '
+    '{"alice": ["127.0.0.1", 10001, true], "bob": ["127.0.0.1", 10002, false], '
+    '"carol": ["127.0.0.1", 10003, true], "dave": ["127.0.0.1", 10004, false]}'
+).encode()
+
 typ_to_str = [
-    "CHAT_MSG", "REGISTER", "DEREGISTER", "ACK_REG", "ACK_DEREG",
-    "ACK_CHAT_MSG"
+    "CHAT_MSG", "REGISTER", "DEREGISTER", "ACK_REG", "NACK_REG", "ACK_DEREG",
+    "NACK_DEREG", "ACK_CHAT_MSG", "PEERS_UPDATE", "SAVE_MSG", "ACK_SAVE_MSG",
+    "NACK_SAVE_MSG", "OFFLINE_MSG", "BROADCAST_MSG", "ACK_BROADCAST_MSG",
+    "STATUS", "ACK_STATUS", "THROTTLE", "REPL_SUBSCRIBE", "REPL_LOG",
+    "ACK_REPL", "NODE_SYNC", "NODE_UPDATE", "NODE_BROADCAST", "FWD_SAVE",
+    "ACK_NODE", "CHAT_COPY", "HISTORY", "SEARCH", "HISTORY_RESULT",
+    "RELAY_MSG", "ACK_RELAY", "WATCH", "ACK_WATCH",
+    "LOOKUP", "LOOKUP_RESULT"
 ]
 
 REGULAR_MESSAGE = 0
 CHANNEL_MESSAGE = 1
 
+# virtual clock of a simulated network (see sim.py), None for the real one
+clock = None
+
 
 def get_ts():
+    if clock is not None:
+        return clock.now()
     return datetime.now().timestamp()
 
 
+def get_monotonic():
+    # for intervals, unaffected by changes to the wall clock
+    if clock is not None:
+        return clock.now()
+    return time.monotonic()
+
+
 def timeout(ts1, ts2):
     # if more than 500 milisecond,
     # retrn true otherwise false
@@ -52,9 +110,21 @@ def msg_type(typ):
 
 
 def msg_id():
+    if clock is not None:
+        return clock.uuid()
     return str(uuid.uuid4())
 
 
+def tag(id, src, dest):
+    return f"{id}{TAG}{src}{TAG}{dest}"
+
+
+def untag(id):
+    # (from, to) names of a tagged id, () if it isn't tagged
+    parts = id.split(TAG) if id is not None else []
+    return tuple(parts[1:]) if len(parts) == 3 else ()
+
+
 def shorten_msg(msg):
     if len(msg) > 25:
         return f"{msg[:25]}.."
@@ -62,15 +132,77 @@ def shorten_msg(msg):
         return msg
 
 
-def make(typ, content="", id=None):
+def deflate(data):
+    c = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -15, zdict=ZDICT)
+    return c.compress(data) + c.flush()
+
+
+def inflate(data, limit=None):
+    # a payload that isn't deflate, or inflates past limit bytes, raises
+    # ValueError
+    d = zlib.decompressobj(-15, zdict=ZDICT)
+    try:
+        if limit is None:
+            return d.decompress(data) + d.flush()
+
+        out = d.decompress(data, limit + 1)
+        if len(out) > limit:
+            raise ValueError("payload inflates past the limit")
+        return out + d.flush()
+    except zlib.error as e:
+        raise ValueError(f"malformed compressed payload: {e}")
+
+
+def make(typ, content="", id=None, compress=False):
+    id = msg_id() if id is None else id
+    payload = str(content).encode()
+    flag = ""
+
+    # only worth it for bulk payloads, and only if it actually shrinks
+    if compress and len(payload) >= COMPRESS_THRESHOLD:
+        deflated = deflate(payload)
+        if len(deflated) < len(payload):
+            payload, flag = deflated, COMPRESSED
+
+    head, id = header(f"{typ}{flag}", id)
+    return head + payload, id
+
+
+def header(typ, id=None):
+    # the encoded "typ id " prefix, for payloads sent as they are
     id = msg_id() if id is None else id
-    msg = map(str, [typ, id, content])
-    encoded = f"{delim.join(msg)}".encode()
-    return encoded, id
+    return f"{typ}{delim}{id}{delim}".encode(), id
 
 
-def parse(msg):
-    decoded = msg.decode()
-    [typ, id, content] = decoded.split(delim, 2)
+def chat_payload(src, chat, raw=None):
+    # the "<src> <chat>" data of a broadcast, as a str and as the byte
+    # buffers sent to every recipient, raw being the chat as received
+    raw = chat.encode() if raw is None else raw
+    return f"{src} {chat}", [f"{src} ".encode(), raw]
+
+
+def parse_header(msg, n=None, limit=None):
+    # parses the type and id of the first n bytes of msg, a bytes or a
+    # (reused) receive buffer, returning the content as a memoryview of msg.
+    # limit bounds the size of compressed content once inflated
+    n = len(msg) if n is None else n
+    sep = delim.encode()
+    i = msg.find(sep, 0, n)
+    j = msg.find(sep, i + 1, n)
+    if i < 0 or j < 0:
+        raise ValueError("malformed message")
+
+    typ = msg[:i].decode()
+    id = msg[i + 1:j].decode()
+    content = memoryview(msg)[j + 1:n]
+
+    if typ.endswith(COMPRESSED):
+        typ = typ[:-len(COMPRESSED)]
+        content = memoryview(inflate(content, limit))
 
     return int(typ), id, content
+
+
+def parse(msg, n=None):
+    typ, id, content = parse_header(msg, n)
+    return typ, id, str(content, "utf-8")
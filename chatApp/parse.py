@@ -2,14 +2,108 @@ import sys
 
 from .log import logger
 from .constant import *
+from .store import POLICIES
+from .transport import is_unix, unix_addr
+
+
+def parse_addr(addr):
+    # "host:port" -> (host, port), "unix:<path>" -> (path, 0)
+    if is_unix(addr):
+        return unix_addr(addr)
+
+    host, port = addr.rsplit(":", 1)
+    return host, parse_port(port)
+
+
+def parse_addrs(addrs):
+    return [parse_addr(addr) for addr in addrs.split(",")]
+
+
+def parse_names(names):
+    return [name for name in names.split(",") if name != ""]
+
+
+def parse_quota(quota):
+    # "messages,bytes" -> (messages, bytes)
+    msgs, size = quota.split(",")
+    msgs, size = int(msgs), int(size)
+
+    if msgs < 1 or size < 1:
+        logger.critical(f"invalid store quota: {quota}, expect at least "
+                        f"1 message and 1 byte")
+        sys.exit(1)
+
+    return msgs, size
+
+
+def parse_policy(policy):
+    if policy not in POLICIES:
+        logger.critical(f"invalid policy: {policy}, expect one of "
+                        f"{', '.join(POLICIES)}")
+        sys.exit(1)
+
+    return policy
+
+
+# server options, each takes a value converted with the given function,
+# except bool options which are flags
+SERVER_OPTIONS = {
+    "--batch": int,
+    "--rcvbuf": int,
+    "--sndbuf": int,
+    "--checkpoint": str,
+    "--restore": bool,
+    "--standby-of": parse_addr,
+    "--standbys": parse_addrs,
+    "--peers": parse_addrs,
+    "--trace": str,
+    "--profile": bool,
+    "--relay": int,
+    "--store-quota": parse_quota,
+    "--store-budget": int,
+    "--store-ttl": float,
+    "--store-policy": parse_policy,
+    "--egress": bool,
+}
+
+CLIENT_OPTIONS = {
+    "--servers": parse_addrs,
+    "--copy-history": bool,
+    "--contacts": parse_names,
+    "--lookup": bool,
+    "--egress": bool,
+    "--trace": str,
+}
+
+HOST_OPTIONS = {
+    "--servers": parse_addrs,
+    "--copy-history": bool,
+    "--egress": bool,
+    "--trace": str,
+}
 
 
 def usage(mode, exit=True):
     if mode == SERVER_MODE:
-        print("Usage: ChatApp -s <port>")
-    elif mode == SERVER_MODE:
-        print(
-            "Usage: ChatApp -c <name> <server-ip> <server-port> <client-port>")
+        print("Usage: ChatApp -s <port>|unix:<path> [--batch <n>] "
+              "[--rcvbuf <bytes>] [--sndbuf <bytes>] "
+              "[--checkpoint <path>] [--restore] [--standby-of <host:port>] "
+              "[--standbys <host:port>,...] "
+              "[--peers <host:port>,...] [--trace <path>] [--profile] "
+              "[--relay <k>] [--store-quota <msgs>,<bytes>] "
+              "[--store-budget <bytes>] [--store-ttl <seconds>] "
+              "[--store-policy drop-oldest|reject] [--egress]")
+    elif mode == CLIENT_MODE:
+        print("Usage: ChatApp -c <name> (<server-ip> <server-port> "
+              "<client-port> | unix:<server-path> unix:<path>) "
+              "[--servers <host:port>,...] [--copy-history] "
+              "[--contacts <name>,...] [--lookup] [--egress] "
+              "[--trace <path>]")
+    elif mode == HOST_MODE:
+        print("Usage: ChatApp -m <name>,... (<server-ip> <server-port> "
+              "<port> | unix:<server-path> unix:<path>) "
+              "[--servers <host:port>,...] [--copy-history] "
+              "[--egress] [--trace <path>]")
 
     if exit:
         sys.exit(1)
@@ -27,22 +121,86 @@ def parse_port(port, exit=True):
     return pno
 
 
+def parse_endpoint(endpoint):
+    # what a node binds to, a port or "unix:<path>"
+    if is_unix(endpoint):
+        return endpoint
+
+    return parse_port(endpoint)
+
+
+def parse_target(args, mode):
+    # "<server-ip> <server-port> <port>" or "unix:<server-path> unix:<path>"
+    # -> server ip, server port, own endpoint and the args left
+    if len(args) > 0 and is_unix(args[0]):
+        if len(args) < 2 or not is_unix(args[1]):
+            logger.critical("a client of a unix: server binds to unix:<path>")
+            usage(mode)
+
+        server_ip, server_port = unix_addr(args[0])
+        return server_ip, server_port, args[1], args[2:]
+
+    if len(args) < 3:
+        logger.critical(f"expect 3 server and port args, got {len(args)}")
+        usage(mode)
+
+    return args[0], parse_port(args[1]), parse_port(args[2]), args[3:]
+
+
+def parse_options(args, mode, spec):
+    # parse "--name value" pairs into keyword arguments
+    options = dict()
+    i = 0
+
+    while i < len(args):
+        flag = args[i]
+        key = flag[2:].replace("-", "_")
+
+        if flag in spec and spec[flag] == bool:
+            options[key] = True
+            i += 1
+            continue
+
+        if flag not in spec or i + 1 >= len(args):
+            logger.critical(f"invalid option: {flag}")
+            usage(mode)
+
+        options[key] = spec[flag](args[i + 1])
+        i += 2
+
+    return options
+
+
 def parse_server_args(args):
-    if len(args) != 2:
+    if len(args) < 2:
         logger.critical(f"expect 1 server arg, got {len(args)-1}")
         usage(args[0])
 
-    return parse_port(args[1])
+    port = parse_endpoint(args[1])
+    options = parse_options(args[2:], args[0], SERVER_OPTIONS)
+
+    return port, options
 
 
 def parse_client_args(args):
-    if len(args) != 5:
+    if len(args) < 2:
         logger.critical(f"expect 4 client args, got {len(args)-1}")
         usage(args[0])
 
     cname = args[1]
-    server_ip = args[2]
-    server_port = parse_port(args[3])
-    client_port = parse_port(args[4])
+    server_ip, server_port, client_port, rest = parse_target(args[2:], args[0])
+    options = parse_options(rest, args[0], CLIENT_OPTIONS)
+
+    return cname, server_ip, server_port, client_port, options
+
+
+def parse_host_args(args):
+    if len(args) < 2:
+        logger.critical(f"expect 4 client host args, got {len(args)-1}")
+        usage(args[0])
+
+    names = parse_names(args[1])
+    server_ip, server_port, port, rest = parse_target(args[2:], args[0])
+    options = parse_options(rest, args[0], HOST_OPTIONS)
 
-    return cname, server_ip, server_port, client_port
+    return names, server_ip, server_port, port, options
@@ -0,0 +1,181 @@
+#
+# On-demand profiling of the server: stack sampling of all threads, time
+# spent per message handler, and wait and hold times of the server lock
+#
+# Stacks are dumped in the folded format of flamegraph.pl ("frame;frame n"
+# per line), handler and lock statistics to a separate text file.
+#
+
+import sys
+import threading
+import time
+from threading import Lock, Thread
+
+from .message import msg_type
+from .constant import PROFILE_INTERVAL
+
+
+class Stat:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def __str__(self):
+        avg = self.total / self.count if self.count > 0 else 0
+        return (f"{self.count:>10}{self.total * 1000:>12.1f}"
+                f"{avg * 1e6:>12.1f}{self.max * 1e6:>12.1f}")
+
+
+class Profiler:
+
+    def __init__(self, path, logger, interval=PROFILE_INTERVAL):
+        self.path = path  # prefix of the files dumped
+        self.logger = logger
+        self.interval = interval
+        self.enabled = False
+        self.mu = Lock()
+        # functions returning more text for the stats file
+        self.reports = []
+        self.reset()
+
+    def reset(self):
+        self.stacks = dict()  # folded stack -> samples
+        self.handlers = dict()  # (kind, message type) -> Stat
+        self.waits = dict()  # thread name -> Stat of lock waits
+        self.holds = dict()  # thread name -> Stat of lock holds
+        self.started = time.time()
+
+    def start(self):
+        self.mu.acquire()
+        self.reset()
+        self.enabled = True
+        self.mu.release()
+
+        Thread(target=self.sample, name="profiler", daemon=True).start()
+        self.logger.info(f"profiling enabled")
+
+    def stop(self):
+        self.enabled = False
+        self.dump()
+
+    def toggle(self, *args):
+        # SIGUSR1 handler
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def sample(self):
+        me = threading.get_ident()
+
+        while self.enabled:
+            names = {t.ident: t.name for t in threading.enumerate()}
+
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    module = frame.f_globals.get("__name__", "?")
+                    frames.append(f"{module}:{code.co_name}")
+                    frame = frame.f_back
+
+                frames.append(names.get(ident, str(ident)))
+                stack = ";".join(reversed(frames))
+
+                self.mu.acquire()
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.mu.release()
+
+            time.sleep(self.interval)
+
+    def record(self, table, key, elapsed):
+        self.mu.acquire()
+        if key not in table:
+            table[key] = Stat()
+        table[key].add(elapsed)
+        self.mu.release()
+
+    def handled(self, kind, typ, elapsed):
+        self.record(self.handlers, (kind, typ), elapsed)
+
+    def dump(self):
+        self.mu.acquire()
+        stacks, handlers = dict(self.stacks), dict(self.handlers)
+        waits, holds = dict(self.waits), dict(self.holds)
+        duration = time.time() - self.started
+        self.mu.release()
+
+        with open(f"{self.path}.folded", "w") as f:
+            for stack, samples in sorted(stacks.items()):
+                f.write(f"{stack} {samples}\n")
+
+        header = (f"{'count':>10}{'total ms':>12}{'avg us':>12}"
+                  f"{'max us':>12}")
+
+        with open(f"{self.path}.stats", "w") as f:
+            f.write(f"profiled {duration:.1f}s\n\n")
+
+            f.write(f"{'handler':<32}{header}\n")
+            for (kind, typ), stat in sorted(handlers.items(),
+                                            key=lambda i: -i[1].total):
+                f.write(f"{kind + ' ' + msg_type(typ):<32}{stat}\n")
+
+            for title, table in (("lock wait", waits), ("lock hold", holds)):
+                f.write(f"\n{title + ' by thread':<32}{header}\n")
+                for thread, stat in sorted(table.items()):
+                    f.write(f"{thread:<32}{stat}\n")
+
+            for report in self.reports:
+                f.write(f"\n{report()}\n")
+
+        self.logger.info(
+            f"profile dumped to {self.path}.folded and {self.path}.stats")
+
+
+class ProfiledLock:
+    # a Lock recording how long threads wait for and hold it while the
+    # profiler is enabled
+
+    def __init__(self, profiler):
+        self.lock = Lock()
+        self.profiler = profiler
+        self.acquired = 0
+
+    def acquire(self):
+        if not self.profiler.enabled:
+            return self.lock.acquire()
+
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+
+        name = threading.current_thread().name
+        self.profiler.record(self.profiler.waits, name, self.acquired - start)
+        return True
+
+    def release(self):
+        if self.profiler.enabled and self.acquired > 0:
+            held = time.perf_counter() - self.acquired
+            name = threading.current_thread().name
+            self.acquired = 0
+            self.lock.release()
+            self.profiler.record(self.profiler.holds, name, held)
+        else:
+            self.acquired = 0
+            self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
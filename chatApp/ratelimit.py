@@ -0,0 +1,93 @@
+#
+# Token buckets used by the server to rate limit requests per source
+#
+
+from threading import Lock
+
+from .message import *
+
+# message type -> (tokens refilled per second, bucket size)
+DEFAULT_LIMITS = {
+    REGISTER: (2, 5),
+    SAVE_MSG: (5, 10),
+    BROADCAST_MSG: (2, 5),
+}
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = now
+        # requests rejected since the last admitted one
+        self.rejected = 0
+
+    def refill(self, now):
+        elapsed = max(now - self.ts, 0)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.ts = now
+
+    def take(self, now):
+        self.refill(now)
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.rejected = 0
+            return True
+
+        self.rejected += 1
+        return False
+
+    def wait_time(self):
+        # seconds until a token is available for the latest rejected
+        # request, assuming the ones rejected before it retry first
+        return (self.rejected - self.tokens) / self.rate
+
+
+class RateLimiter:
+
+    def __init__(self, limits=DEFAULT_LIMITS):
+        self.limits = limits
+        self.buckets = dict()
+        self.throttled = 0
+        self.dropped = 0
+        # checked by the listener, pruned by the timeout thread
+        self.mu = Lock()
+
+    def check(self, addr, typ, now):
+        # returns (allowed, retry after in seconds), retry after is None
+        # if the source ignores back off and the request should be dropped
+        if typ not in self.limits:
+            return True, 0
+
+        key = (addr, typ)
+        self.mu.acquire()
+
+        if key not in self.buckets:
+            rate, burst = self.limits[typ]
+            self.buckets[key] = TokenBucket(rate, burst, now)
+
+        bucket = self.buckets[key]
+        if bucket.take(now):
+            result = True, 0
+        elif bucket.rejected > bucket.burst:
+            self.dropped += 1
+            result = False, None
+        else:
+            self.throttled += 1
+            result = False, bucket.wait_time()
+
+        self.mu.release()
+        return result
+
+    def prune(self, now):
+        # forget sources whose bucket has refilled, they are idle
+        self.mu.acquire()
+        for key in list(self.buckets):
+            bucket = self.buckets[key]
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+        self.mu.release()
@@ -0,0 +1,36 @@
+#
+# Relay trees for broadcasts: the server sends a broadcast to k clients
+# (relays) only, each relaying it to its share of the other recipients,
+# and so on down the tree
+#
+# A relay gets the chat with the names and addresses of its subtree. It
+# splits them into k groups, the first of each relaying to the rest, and
+# once all of those reported back or timed out it reports the names the
+# chat reached to whoever sent it the chat. The server then delivers
+# directly to every name a subtree didn't report.
+#
+
+from .constant import TIMEOUT
+
+# ids of broadcasts a relay reported kept, so a duplicate isn't relayed again
+REPORTED_IDS = 1024
+
+
+def split(names, k):
+    # up to k groups of about the same size, as (relay, names it relays to)
+    size = -(-len(names) // k)
+    return [(names[i], names[i + 1:i + size])
+            for i in range(0, len(names), size)]
+
+
+def height(n, k):
+    # levels of relays below a relay to n names
+    if n == 0:
+        return 0
+    return 1 + height(-(-n // k) - 1, k)
+
+
+def wait(n, k):
+    # milliseconds to wait for the report of a relay to n names. Each level
+    # waits for the timeouts of the one below, plus a tick of the timer
+    return (2 * height(n, k) + 1) * TIMEOUT
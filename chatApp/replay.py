@@ -0,0 +1,140 @@
+#
+# Replays the datagrams a server received, as recorded with --trace, against
+# a fresh server and reports the latency of its responses, run with:
+#
+#   python -m chatApp.replay <trace> <port> [1|10|max]
+#
+# Every source address in the trace gets its own socket, so the server sees
+# as many clients as were recorded. Acks to server-initiated messages carry
+# ids of the recorded run, so they are not replayed; instead the replaying
+# clients ack STATUS and BROADCAST_MSG from the fresh server themselves.
+#
+
+import json
+import selectors
+import socket
+import sys
+import time
+from threading import Thread, Lock
+
+from .message import *
+from .constant import BUF_SIZE
+from .trace import read, RECV
+from .bench import start_server, percentile
+
+# not replayed, acks to the recorded server's own messages
+SKIPPED = (ACK_STATUS, ACK_BROADCAST_MSG, ACK_REPL, ACK_NODE)
+
+# seconds to wait for responses after the last datagram was sent
+DRAIN = 2
+
+
+class Replayer:
+
+    def __init__(self, port, speed):
+        self.server = ("127.0.0.1", port)
+        self.speed = speed
+        self.socks = dict()  # recorded source addr -> socket
+        self.selector = selectors.DefaultSelector()
+        self.pending = dict()  # id -> (type, time sent)
+        self.latencies = dict()  # type -> [seconds]
+        self.mu = Lock()
+        self.done = False
+
+    def sock_for(self, addr):
+        if addr not in self.socks:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", 0))
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.socks[addr] = sock
+
+        return self.socks[addr]
+
+    def receive(self, sock):
+        msg, addr = sock.recvfrom(BUF_SIZE)
+        now = time.perf_counter()
+        typ, id, _ = parse(msg)
+
+        if typ == STATUS:
+            ack, _ = make(ACK_STATUS, json.dumps(True), id=id)
+            sock.sendto(ack, addr)
+        elif typ == BROADCAST_MSG:
+            ack, _ = make(ACK_BROADCAST_MSG, id=id)
+            sock.sendto(ack, addr)
+
+        self.mu.acquire()
+        if id in self.pending:
+            req, sent = self.pending.pop(id)
+            self.latencies.setdefault(req, []).append(now - sent)
+        self.mu.release()
+
+    def listen(self):
+        while not self.done:
+            for key, _ in self.selector.select(timeout=0.1):
+                self.receive(key.fileobj)
+
+    def run(self, records):
+        listener = Thread(target=self.listen, daemon=True)
+        listener.start()
+
+        start = time.perf_counter()
+        first = records[0][0] if len(records) > 0 else 0
+        sent = 0
+
+        for ts, addr, data in records:
+            typ, id, _ = parse(data)
+            if typ in SKIPPED:
+                continue
+
+            if self.speed != "max":
+                delay = (ts - first) / float(self.speed)
+                time.sleep(max(start + delay - time.perf_counter(), 0))
+
+            sock = self.sock_for(addr)
+            self.mu.acquire()
+            self.pending[id] = (typ, time.perf_counter())
+            self.mu.release()
+            sock.sendto(data, self.server)
+            sent += 1
+
+        elapsed = time.perf_counter() - start
+        time.sleep(DRAIN)
+        self.done = True
+        listener.join()
+
+        self.report(sent, elapsed)
+
+    def report(self, sent, elapsed):
+        answered = sum(map(len, self.latencies.values()))
+        print(f"replayed {sent} datagrams from {len(self.socks)} clients in "
+              f"{elapsed:.2f}s at speed {self.speed}, {answered} answered")
+        print(f"{'request':<16}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}"
+              f"{'p99 ms':>10}{'max ms':>10}")
+
+        for typ, values in sorted(self.latencies.items()):
+            ms = [v * 1000 for v in values]
+            print(f"{msg_type(typ):<16}{len(ms):>8}{percentile(ms, 50):>10.2f}"
+                  f"{percentile(ms, 90):>10.2f}{percentile(ms, 99):>10.2f}"
+                  f"{max(ms):>10.2f}")
+
+
+def main():
+    args = sys.argv[1:]
+
+    if len(args) < 2 or (len(args) > 2 and args[2] not in ("1", "10", "max")):
+        print("Usage: python -m chatApp.replay <trace> <port> [1|10|max]")
+        sys.exit(1)
+
+    path, port = args[0], int(args[1])
+    speed = args[2] if len(args) > 2 else "1"
+
+    records = [(ts, addr, data) for ts, direction, addr, data in read(path)
+               if direction == RECV]
+
+    server = start_server(port)
+    Replayer(port, speed).run(records)
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
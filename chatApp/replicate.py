@@ -0,0 +1,220 @@
+#
+# Streaming replication of server state from a primary to hot standbys
+#
+# The primary ships changed clients, msg_store and negotiated entries to
+# every subscribed standby as REPL_LOG batches [seq, ts, entries], using the same
+# [table, key, value] entries as the checkpoint journal. A fourth element
+# marks msg_store records appended to the key, used when a queue is too
+# large for one datagram. Standbys ack every batch, apply batches in seq
+# order and re-subscribe (getting a full resync) when the primary is silent.
+#
+
+import json
+import time
+
+from .message import *
+from .checkpoint import Journal
+from .transport import resolve
+from .constant import (BUF_SIZE, REPL_INTERVAL, REPL_HEARTBEAT, REPL_RETRIES,
+                       REPL_SILENCE)
+
+REPLICATED = ("clients", "msg_store", "negotiated")
+
+# room left in a datagram for the header and the batch envelope
+BATCH_BYTES = BUF_SIZE - 128
+
+
+def pack(changes):
+    # split changes into lists of entries that each fit in a datagram
+    batches = [[]]
+    size = 0
+
+    for table, key, value in changes:
+        entries = [[table, key, value]]
+
+        if len(json.dumps(entries[0])) > BATCH_BYTES and type(value) == list:
+            # too large: send the records in parts, appending to the first
+            entries, part = [], []
+            for record in value:
+                part.append(record)
+                if len(json.dumps(part)) > BATCH_BYTES // 2:
+                    entries.append([table, key, part, len(entries) > 0])
+                    part = []
+            entries.append([table, key, part, len(entries) > 0])
+
+        for entry in entries:
+            n = len(json.dumps(entry)) + 2
+            if size + n > BATCH_BYTES and len(batches[-1]) > 0:
+                batches.append([])
+                size = 0
+            batches[-1].append(entry)
+            size += n
+
+    return batches
+
+
+class Replicator(Journal):
+    # runs on the primary
+
+    def __init__(self, server, allowed=(), interval=REPL_INTERVAL):
+        super().__init__(server, REPLICATED)
+        # the only addresses that may subscribe, a resync carries every
+        # client and saved message
+        self.allowed = set(map(resolve, allowed))
+        self.interval = interval
+        self.standbys = dict()  # addr -> seq of the next batch
+        self.attempts = dict()  # (addr, seq) -> sends so far
+        self.last_ship = 0
+
+    def mark(self, table, key):
+        # nothing to track until a standby subscribes
+        if len(self.standbys) > 0:
+            super().mark(table, key)
+
+    def subscribe(self, addr):
+        # called with lock held, a (re-)subscribing standby gets everything
+        if addr not in self.allowed:
+            self.server.logger.info(
+                f"REPL_SUBSCRIBE from {addr}, not a standby of ours, ignored")
+            return
+
+        self.standbys[addr] = 0
+        self.mark_all()
+        self.server.logger.info(f"standby @ {addr} subscribed, full resync")
+
+    def send(self, addr, seq, batch):
+        # called with lock held
+        data = json.dumps([seq, get_ts(), batch])
+        resp, id = make(REPL_LOG, data, compress=True)
+        self.server.sock.sendto(resp, addr)
+        self.server.record(id, addr, REPL_LOG, data)
+
+    def resend(self, addr, data):
+        # called with lock held, when a batch wasn't acked in time
+        [seq, ts, batch] = json.loads(data)
+        key = (addr, seq)
+        self.attempts[key] = self.attempts.get(key, 1) + 1
+
+        if addr not in self.standbys:
+            self.attempts.pop(key)
+        elif self.attempts[key] > REPL_RETRIES:
+            # standby is gone, it resubscribes when it comes back
+            self.server.logger.info(f"standby @ {addr} not responding, drop")
+            del self.standbys[addr]
+            self.attempts = {
+                k: v
+                for k, v in self.attempts.items() if k[0] != addr
+            }
+        else:
+            self.send(addr, seq, batch)
+
+    def ack(self, addr, data):
+        # called with lock held
+        [seq, ts, batch] = json.loads(data)
+        self.attempts.pop((addr, seq), None)
+
+    def ship(self):
+        changes = self.take()
+        now = time.time()
+
+        # an empty batch doubles as a heartbeat
+        if len(changes) == 0 and now - self.last_ship < REPL_HEARTBEAT:
+            return
+
+        self.last_ship = now
+        batches = pack(changes)
+
+        self.server.mu.acquire()
+        for addr in self.standbys:
+            for batch in batches:
+                seq = self.standbys[addr]
+                self.standbys[addr] += 1
+                self.send(addr, seq, batch)
+        self.server.mu.release()
+
+    def run(self):
+        while not self.server.done:
+            time.sleep(self.interval)
+            self.ship()
+
+
+class Standby:
+    # runs on a standby, until it is promoted
+
+    def __init__(self, server, primary):
+        self.server = server
+        self.primary = resolve(primary)
+        self.expected = 0
+        self.pending = dict()  # seq -> (ts, entries) received out of order
+        # from the primary, or since we started
+        self.last_heard = time.time()
+        self.max_lag = 0
+
+    def alive(self):
+        # whether the primary was heard from lately
+        return time.time() - self.last_heard < REPL_SILENCE
+
+    def subscribe(self):
+        self.expected = 0
+        self.pending = dict()
+
+        resp, _ = make(REPL_SUBSCRIBE)
+        self.server.sock.sendto(resp, self.primary)
+        self.server.logger.info(f"subscribing to primary @ {self.primary}")
+
+    def apply(self, entries):
+        # called with lock held
+        for [table, key, value, *append] in entries:
+            data = getattr(self.server, table)
+
+            if table == "msg_store" and value is not None:
+                value = [tuple(record) for record in value]
+
+            if value is None:
+                data.pop(key, None)
+            elif len(append) > 0 and append[0]:
+                data[key].extend(value)
+            else:
+                data[key] = value
+
+            self.server.changed(table, key)
+
+    def handle_log(self, id, addr, content):
+        # called with lock held
+        if addr != self.primary:
+            return
+
+        self.last_heard = time.time()
+        [seq, ts, entries] = json.loads(content)
+
+        resp, _ = make(ACK_REPL, id=id)
+        self.server.sock.sendto(resp, addr)
+
+        if seq >= self.expected:
+            self.pending[seq] = (ts, entries)
+
+        while self.expected in self.pending:
+            ts, entries = self.pending.pop(self.expected)
+            self.apply(entries)
+            self.expected += 1
+
+            lag = int(get_ts() * 1000 - ts * 1000)
+            self.max_lag = max(self.max_lag, lag)
+            if len(entries) > 0:
+                self.server.logger.info(
+                    f"applied batch {self.expected - 1} "
+                    f"({len(entries)} entries), replication lag {lag}ms "
+                    f"(max {self.max_lag}ms)")
+
+    def run(self):
+        self.subscribe()
+
+        while not self.server.done:
+            time.sleep(REPL_SILENCE)
+
+            if self.primary is None:
+                # promoted
+                return
+
+            if time.time() - self.last_heard > REPL_SILENCE:
+                self.subscribe()
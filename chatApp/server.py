@@ -1,23 +1,124 @@
 import json
+import signal
 import socket
 import time
-from threading import Thread, Lock
+from collections import Counter
+from threading import Thread, current_thread, main_thread
 
 from .log import logger
 from .message import *
-from .constant import BUF_SIZE
+from .ratelimit import RateLimiter, DEFAULT_LIMITS
+from .checkpoint import Checkpointer, load
+from .replicate import Replicator, Standby
+from .federation import Federation
+from .history import History, CHANNEL
+from .trace import TracingSocket
+from .transport import bind, label
+from .egress import EgressSocket
+from .profiler import Profiler, ProfiledLock
+from .relay import split, wait
+from .store import StoreQuota, DROP_OLDEST, UNKNOWN_USER
+from .constant import (BUF_SIZE, BATCH_SIZE, STORE_MAX_MSGS, STORE_MAX_BYTES,
+                       STORE_BUDGET, STORE_TTL)
+
+# requests whose handler takes the content as received, a memoryview into a
+# receive buffer which is only valid until the next batch is received
+RAW_CONTENT = (BROADCAST_MSG,)
+
+# requests only clients send, a standby receiving one takes over
+CLIENT_REQUESTS = (REGISTER, DEREGISTER, SAVE_MSG, BROADCAST_MSG, CHAT_COPY,
+                   HISTORY, SEARCH, WATCH, LOOKUP)
 
 
 class Server:
 
-    def __init__(self, port, logger=logger):
+    def __init__(self,
+                 port,
+                 logger=logger,
+                 rate_limits=DEFAULT_LIMITS,
+                 batch=BATCH_SIZE,
+                 rcvbuf=None,
+                 sndbuf=None,
+                 checkpoint=None,
+                 restore=False,
+                 standby_of=None,
+                 standbys=None,
+                 peers=None,
+                 trace=None,
+                 profile=False,
+                 relay=0,
+                 store_quota=(STORE_MAX_MSGS, STORE_MAX_BYTES),
+                 store_budget=STORE_BUDGET,
+                 store_ttl=STORE_TTL,
+                 store_policy=DROP_OLDEST,
+                 egress=False):
         self.done = False
         self.port = port
         self.logger = logger
+        # socket buffer sizes, None keeps the OS default
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        # file to record every datagram sent or received to, if any
+        self.trace = trace
+        # send through a prioritized, paced queue instead of inline
+        self.egress = egress
+        # receive buffers reused for every batch of datagrams, batching
+        # needs a non-blocking recv flag which not every platform has
+        if not hasattr(socket, "MSG_DONTWAIT"):
+            batch = 1
+        self.pool = [bytearray(BUF_SIZE) for _ in range(batch)]
+        # state is snapshotted to a journal file if a path is given,
+        # restoring without one uses a default path
+        if restore and checkpoint is None:
+            checkpoint = f"server-{label(port)}.ckpt"
+        self.restore = restore
+        self.checkpointer = None if checkpoint is None else \
+            Checkpointer(self, checkpoint)
+        # state changes are streamed to the standbys listed that subscribed
+        # to us, and we follow the primary at standby_of until a client
+        # fails over to us
+        self.replicator = Replicator(self, standbys or [])
+        self.standby = None if standby_of is None else \
+            Standby(self, standby_of)
+        # other servers (nodes) we federate with, each owning its users
+        self.federation = Federation(self, peers or [])
+        self.journals = [self.replicator, self.federation]
+        # broadcasts go to this many relay clients, which pass them on to
+        # the others, or directly to every client if 0
+        self.relay = relay
+        # saved, broadcast and (if clients send a copy) direct chats
+        self.history = History()
+        if self.checkpointer is not None:
+            self.journals.append(self.checkpointer)
         self.clients = dict()
         self.msg_store = dict()
+        # bounds msg_store per recipient and overall, and expires from it
+        self.store = StoreQuota(self, *store_quota, store_budget, store_ttl,
+                                store_policy)
         self.inflight = dict()
-        self.mu = Lock()
+        # STATUS id -> what to do once the client acked it or timed out
+        self.probes = dict()
+        # options each client offered at registration, journaled so that
+        # the sets below are rebuilt after a restore or a takeover
+        self.negotiated = dict()
+        # clients that negotiated compressed bulk messages at registration
+        self.zlib_clients = set()
+        # clients that want their name tagged on the ids of our messages,
+        # the identities of a client host
+        self.tagged_clients = set()
+        # the users each client wants presence updates of, if it declared
+        # an interest set, and who is interested in each user
+        self.interests = dict()
+        self.watchers = dict()
+        self.limiter = RateLimiter(rate_limits)
+        # "<error> in <step>" -> datagrams dropped as malformed or failing
+        # in a handler
+        self.errors = Counter()
+        # stack samples, handler times and lock contention, collected from
+        # startup with profile or between two SIGUSR1
+        self.profile = profile
+        self.profiler = Profiler(f"server-{label(port)}.profile", logger)
+        self.mu = ProfiledLock(self.profiler)
         self.handlers = {
             REGISTER: self.handle_register,
             CHAT_MSG: self.handle_chat,
@@ -25,29 +126,70 @@ class Server:
             SAVE_MSG: self.handle_save,
             BROADCAST_MSG: self.handle_broadcast_msg,
             ACK_BROADCAST_MSG: self.handle_ack_broadcast_msg,
-            ACK_STATUS: self.handle_status_ack
+            ACK_STATUS: self.handle_status_ack,
+            REPL_SUBSCRIBE: self.handle_repl_subscribe,
+            REPL_LOG: self.handle_repl_log,
+            ACK_REPL: self.handle_ack_repl,
+            NODE_SYNC: self.federation.handle_sync,
+            NODE_UPDATE: self.federation.handle_update,
+            NODE_BROADCAST: self.federation.handle_broadcast,
+            FWD_SAVE: self.federation.handle_forward_save,
+            ACK_NODE: self.handle_ack_node,
+            CHAT_COPY: self.handle_chat_copy,
+            HISTORY: self.handle_history,
+            SEARCH: self.handle_search,
+            ACK_RELAY: self.handle_ack_relay,
+            WATCH: self.handle_watch,
+            LOOKUP: self.handle_lookup
         }
         self.timeout_handlers = {
             BROADCAST_MSG: self.timeout_broadcast_msg,
-            STATUS: self.timeout_status
+            STATUS: self.timeout_status,
+            REPL_LOG: self.timeout_repl_log,
+            NODE_SYNC: self.timeout_node_msg,
+            NODE_UPDATE: self.timeout_node_msg,
+            NODE_BROADCAST: self.timeout_node_msg,
+            FWD_SAVE: self.timeout_node_msg,
+            RELAY_MSG: self.timeout_relay_msg
         }
 
-        self.logger.info(f"instantiated server @ port {self.port}")
+        self.logger.info(f"instantiated server @ {self.port}")
 
-    def find_client_by_addr(self, addr):
+    def find_client_by_addr(self, addr, id=None):
+        # the identities of a client host share its address, told apart by
+        # the names tagged on the id of their message or of ours they ack
         user_ip, user_port = addr
+        for name in untag(id):
+            if name in self.clients and \
+                    self.clients[name][:2] == [user_ip, user_port]:
+                return name
+
         for name, [ip, port, _] in self.clients.items():
             if user_ip == ip and user_port == port:
                 return name
 
         return None
 
+    def changed(self, table, key):
+        # called with lock held whenever an entry of a journaled table
+        # (clients, msg_store, inflight, negotiated) is set or deleted
+        for journal in self.journals:
+            journal.mark(table, key)
+
+    def new_id(self, client):
+        # id of a message we send client, None to let make pick one
+        if client in self.tagged_clients:
+            return tag(msg_id(), "", client)
+        return None
+
     def client_info_str(self, name):
         return f"({', '.join(map(str, self.clients[name]))})"
 
-    def record(self, id, addr, typ, data):
-        ts = get_ts()
+    def record(self, id, addr, typ, data, wait=TIMEOUT):
+        # times out after wait milliseconds
+        ts = get_ts() + (wait - TIMEOUT) / 1000
         self.inflight[id] = (ts, addr, typ, data)
+        self.changed("inflight", id)
 
     def rm_record(self, id):
         if id in self.inflight:
@@ -55,28 +197,84 @@ class Server:
             duration = int(get_ts() * 1000 - ts * 1000)
 
             del self.inflight[id]
+            self.changed("inflight", id)
             self.logger.info(
                 f"msg {id} acked, remove from inflight ({duration}ms)")
 
+    def subscribe(self, client, names):
+        # set the users client gets presence updates of, None for everyone
+        for name in self.interests.pop(client, ()):
+            self.watchers[name].discard(client)
+            if len(self.watchers[name]) == 0:
+                del self.watchers[name]
+
+        if names is not None:
+            self.interests[client] = set(names)
+            for name in names:
+                self.watchers.setdefault(name, set()).add(client)
+
+    def directory_for(self, client, include=()):
+        # the peer table of a client, limited to its interests and itself
+        # (and include) if it declared any
+        if client not in self.interests:
+            return self.federation.directory()
+
+        return self.federation.directory(
+            self.interests[client] | {client, *include})
+
+    def broadcast_peers(self, updates, exclude=None):
+        # send a table update to all online clients interested in any of
+        # the updated users, but exclude
+        info = json.dumps(updates)
+        recipients = set()
+        for name in updates:
+            recipients |= self.watchers.get(name, set())
+
+        if len(self.interests) < len(self.clients):
+            # some clients get every update
+            recipients |= {c for c in self.clients if c not in self.interests}
+
+        # in a fixed order, for simulations to be reproducible
+        for client in sorted(recipients):
+            [ip, port, online] = self.clients[client]
+            if not online or client == exclude:
+                continue
+
+            data = info
+            if client in self.interests:
+                names = self.interests[client].intersection(updates)
+                if len(names) < len(updates):
+                    data = json.dumps({name: updates[name] for name in names})
+
+            self.logger.info(
+                f"Broadcast info of {', '.join(updates)} "
+                f"to {client} @ {ip}:{port}")
+            resp, _ = make(PEERS_UPDATE,
+                           data,
+                           self.new_id(client),
+                           compress=client in self.zlib_clients)
+            self.sock.sendto(resp, (ip, port))
+
     def broadcast_client_info(self, user):
-        user_info = json.dumps({user: self.clients[user]})
+        self.broadcast_peers({user: self.clients[user]}, exclude=user)
 
-        for client, [ip, port, online] in self.clients.items():
-            if online and client != user:
-                self.logger.info(
-                    f"Broadcast client {user} info: "
-                    f"{self.clients[user]} to {client} @ {ip}:{port}")
-                resp, _ = make(PEERS_UPDATE, user_info)
-                self.sock.sendto(resp, (ip, port))
+    def sendv(self, buffers, dest):
+        # sends the buffers as one datagram without joining them first
+        if hasattr(self.sock, "sendmsg"):
+            self.sock.sendmsg(buffers, [], 0, dest)
+        else:
+            self.sock.sendto(b"".join(buffers), dest)
 
-    def broadcast_chat(self, from_cli, to_cli, chat):
+    def broadcast_chat(self, from_cli, to_cli, chat, payload=None):
+        # payload, from chat_payload, is shared by all recipients of a
+        # broadcast so it is not rebuilt for each
         [to_ip, to_port, online] = self.clients[to_cli]
         dest = (to_ip, to_port)
 
         if online:
-            data = f"{from_cli} {chat}"
-            resp, id = make(BROADCAST_MSG, data)
-            self.sock.sendto(resp, dest)
+            data, buffers = payload or chat_payload(from_cli, chat)
+            head, id = header(BROADCAST_MSG, self.new_id(to_cli))
+            self.sendv([head, *buffers], dest)
             self.logger.info(
                 f"broadcast message from {from_cli} to {to_cli}: {shorten_msg(chat)}"
             )
@@ -85,15 +283,27 @@ class Server:
         else:
             self.save_msg(from_cli, to_cli, chat, typ=CHANNEL_MESSAGE)
 
-    def wait_status(self, id):
-        cond = True
+    def probe(self, client, then):
+        # ask client for its status, then() is called with lock held once
+        # it acked or timed out
+        dest = (self.clients[client][0], self.clients[client][1])
+        resp, id = make(STATUS, id=self.new_id(client))
+        self.sock.sendto(resp, dest)
+        self.record(id, dest, STATUS, "")
+        self.probes[id] = then
 
-        while cond:
-            self.mu.acquire()
-            cond = id in self.inflight
-            self.mu.release()
+    def probed(self, id):
+        if id in self.probes:
+            self.probes.pop(id)()
 
     def save_msg(self, src, dest, msg, typ=REGULAR_MESSAGE):
+        # returns why msg couldn't be saved, None if it was
+        reason = self.store.admit(dest, msg)
+        if reason is not None:
+            self.logger.info(f"Message {shorten_msg(msg)} for {dest} from "
+                             f"{src} rejected: {reason}")
+            return reason
+
         timestamp = get_ts()
         record = (timestamp, src, msg, typ)
 
@@ -101,48 +311,191 @@ class Server:
             self.msg_store[dest].append(record)
         else:
             self.msg_store[dest] = [record]
+        self.store.added(dest, record)
+        self.changed("msg_store", dest)
 
         self.logger.info(
             f"Message {shorten_msg(msg)} for {dest} from {src} saved!")
+        return None
 
     def clear_msg(self, client):
         msgs = self.msg_store[client] if client in self.msg_store else []
         self.msg_store.pop(client, None)
+        self.store.removed(client, msgs)
+        self.changed("msg_store", client)
 
         return msgs
 
+    def admit(self, typ, id, addr):
+        # the identities of a client host are limited each, as the clients
+        # of a host would be if they had their own ports. Tags are the
+        # sender's word, only names registered from addr as identities of
+        # a host count, anything else is limited by address
+        names = untag(id)
+        name = names[0] if len(names) > 0 else ""
+        info = self.clients.get(name)
+
+        if name in self.tagged_clients and info is not None and \
+                info[:2] == list(addr):
+            source = (addr, name)
+        else:
+            source = addr
+        allowed, wait = self.limiter.check(source, typ, get_ts())
+
+        if allowed:
+            return True
+
+        if wait is None:
+            self.logger.info(
+                f"dropped request {id} from {addr}, source ignores back off "
+                f"(dropped: {self.limiter.dropped})")
+        else:
+            # tell the source when it may retry
+            retry_after = int(wait * 1000) + 1
+            resp, _ = make(THROTTLE, retry_after, id=id)
+            self.sock.sendto(resp, addr)
+            self.logger.info(
+                f"throttled request {id} from {addr} for {retry_after}ms "
+                f"(throttled: {self.limiter.throttled})")
+
+        return False
+
+    def receive_batch(self):
+        # block for the first datagram, then drain the ones already queued
+        # on the socket, up to one per buffer in the pool
+        n, addr = self.sock.recvfrom_into(self.pool[0])
+        batch = [(self.pool[0], n, addr)]
+
+        for buf in self.pool[1:]:
+            try:
+                n, addr = self.sock.recvfrom_into(buf, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+
+            batch.append((buf, n, addr))
+
+        return batch
+
+    def handle_batch(self):
+        requests = []
+
+        for buf, n, client_addr in self.receive_batch():
+            try:
+                # only the header is decoded before the request is admitted,
+                # nothing we receive inflates past a datagram
+                typ, id, content = parse_header(buf, n, BUF_SIZE)
+                if typ not in self.handlers:
+                    raise ValueError(f"unknown message type {typ}")
+
+                # rate limit before the request can fan out
+                if not self.admit(typ, id, client_addr):
+                    continue
+                if typ not in RAW_CONTENT:
+                    content = str(content, "utf-8")
+            except ValueError as e:
+                self.drop("parse_header", client_addr, e)
+                continue
+
+            requests.append((typ, id, client_addr, content))
+
+        # dispatch the whole batch under one lock acquisition
+        self.mu.acquire()
+        try:
+            for typ, id, client_addr, content in requests:
+                try:
+                    if self.standby is not None and typ in CLIENT_REQUESTS \
+                            and not self.promote(typ, client_addr):
+                        continue
+                    self.dispatch("handle", self.handlers, typ, id,
+                                  client_addr, content)
+                except Exception as e:
+                    self.drop(msg_type(typ), client_addr, e)
+        finally:
+            self.mu.release()
+
+    def drop(self, stage, addr, error):
+        # a datagram that couldn't be decoded or handled is counted and
+        # dropped, the others of its batch are still handled. Counted by
+        # kind only, senders choose what the messages say
+        self.errors[f"{type(error).__name__} in {stage}"] += 1
+        self.logger.error(f"dropped datagram from {addr}, "
+                          f"{type(error).__name__} in {stage}: {error}")
+
     def handle_requests(self):
         while not self.done:
-            msg, client_addr = self.sock.recvfrom(BUF_SIZE)
-            typ, id, content = parse(msg)
+            self.handle_batch()
+
+    def dispatch(self, kind, handlers, typ, id, addr, content):
+        if not self.profiler.enabled:
+            handlers[typ](id, addr, content)
+            return
+
+        start = time.perf_counter()
+        handlers[typ](id, addr, content)
+        self.profiler.handled(kind, typ, time.perf_counter() - start)
+
+    def promote(self, typ, addr):
+        # a client failed over to us, stop following the primary unless
+        # it is still up (the client only lost touch with it), returns
+        # whether we were promoted
+        if self.standby.alive():
+            self.logger.info(
+                f"{msg_type(typ)} from {addr} while primary @ "
+                f"{self.standby.primary} is up, refused")
+            return False
 
-            self.mu.acquire()
-            self.handlers[typ](id, client_addr, content)
-            self.mu.release()
+        self.logger.info(
+            f"request from a client, promoted to primary "
+            f"(was standby of {self.standby.primary})")
+        self.standby.primary = None
+        self.standby = None
+        self.store.rebuild()
+        for name, options in self.negotiated.items():
+            self.apply_options(name, options)
+        return True
 
     def handle_register(self, id, dest, info):
         ip, port = dest
-        [name, status] = json.loads(info)
+        [name, status, *opts] = json.loads(info)
+        # older clients send no options
+        options = opts[0] if opts else {}
 
         self.logger.info(f"client @ {ip}:{port} wants to register as {name}.")
 
-        if name not in self.clients:
+        if self.federation.owner(name) is not None:
+            # registered with another node
+            self.logger.info(
+                f"Denied. {name} already registered with node @ "
+                f"{self.federation.owner(name)}")
+            resp, _ = make(NACK_REG, id=id)
+            self.sock.sendto(resp, dest)
+        elif name not in self.clients:
             # client doesn't exist, register for the first time
             self.logger.info(f"Accepted. Client {name} registered.")
 
             self.clients[name] = [ip, port, status]
-            resp, _ = make(ACK_REG, json.dumps(self.clients), id)
+            self.changed("clients", name)
+            self.negotiate(name, options)
+            resp, _ = make(ACK_REG,
+                           json.dumps(self.directory_for(name)),
+                           id,
+                           compress=name in self.zlib_clients)
             self.sock.sendto(resp, dest)
 
             self.broadcast_client_info(name)
         elif dest == (self.clients[name][0], self.clients[name][1]):
             online = self.clients[name][2]
+            self.negotiate(name, options)
+            zlib_ok = name in self.zlib_clients
             # same client, re-register
             if online:
                 self.logger.info(
                     f"client {name} @ {ip}:{port} already registered -> no op, sending ack."
                 )
-                resp, _ = make(ACK_REG, json.dumps(self.clients), id=id)
+                resp, _ = make(ACK_REG,
+                               json.dumps(self.directory_for(name)),
+                               id=id,
+                               compress=zlib_ok)
                 self.sock.sendto(resp, dest)
             else:
                 # client went back online
@@ -152,12 +505,19 @@ class Server:
 
                 # check for offline messages and send to client if any
                 data = json.dumps(self.clear_msg(name))
-                resp, _ = make(OFFLINE_MSG, data)
+                resp, _ = make(OFFLINE_MSG,
+                               data,
+                               self.new_id(name),
+                               compress=zlib_ok)
                 self.sock.sendto(resp, dest)
 
                 # set client status to true and broadcast table
                 self.clients[name][2] = True
-                resp, _ = make(ACK_REG, json.dumps(self.clients), id)
+                self.changed("clients", name)
+                resp, _ = make(ACK_REG,
+                               json.dumps(self.directory_for(name)),
+                               id,
+                               compress=zlib_ok)
                 self.sock.sendto(resp, dest)
 
                 self.broadcast_client_info(name)
@@ -169,6 +529,52 @@ class Server:
             resp, _ = make(NACK_REG, id=id)
             self.sock.sendto(resp, dest)
 
+    def negotiate(self, name, options):
+        self.negotiated[name] = options
+        self.changed("negotiated", name)
+        self.apply_options(name, options)
+
+    def apply_options(self, name, options):
+        if options.get("compress") == "zlib":
+            self.zlib_clients.add(name)
+        else:
+            self.zlib_clients.discard(name)
+
+        if options.get("ids") == "tagged":
+            self.tagged_clients.add(name)
+        else:
+            self.tagged_clients.discard(name)
+
+        self.subscribe(name, options.get("interests"))
+
+    def handle_watch(self, id, dest, info):
+        # a client replacing its interest set, gets the current info of
+        # the users it added
+        client = self.find_client_by_addr(dest, id)
+        if client is None:
+            return
+
+        names = set(json.loads(info))
+        added = names - self.interests.get(client, set())
+        self.subscribe(client, names)
+        self.negotiated[client] = {
+            **self.negotiated.get(client, {}), "interests": sorted(names)
+        }
+        self.changed("negotiated", client)
+
+        resp, _ = make(ACK_WATCH,
+                       json.dumps(self.federation.directory(added)),
+                       id=id,
+                       compress=client in self.zlib_clients)
+        self.sock.sendto(resp, dest)
+
+    def handle_lookup(self, id, dest, name):
+        # info of a single user, ours or another node's, null if unknown
+        info = self.federation.directory([name]).get(name)
+
+        resp, _ = make(LOOKUP_RESULT, json.dumps([name, info]), id=id)
+        self.sock.sendto(resp, dest)
+
     def handle_deregister(self, id, dest, info):
         ip, port = dest
         name = info
@@ -177,6 +583,7 @@ class Server:
 
         # mark client as offline
         self.clients[name][2] = False
+        self.changed("clients", name)
 
         self.logger.info(f"de-registered client {name} @ {ip}:{port}.")
 
@@ -188,13 +595,13 @@ class Server:
         self.broadcast_client_info(name)
 
     def handle_chat(self, id, dest, message):
-        logger.info(f"message from {dest} received: {message}")
+        self.logger.info(f"message from {dest} received: {message}")
 
         resp, _ = make(ACK_CHAT_MSG, id=id)
         self.sock.sendto(resp, dest)
 
     def handle_status_ack(self, id, dest, message):
-        client = self.find_client_by_addr(dest)
+        client = self.find_client_by_addr(dest, id)
 
         if id not in self.inflight:
             self.logger.info(
@@ -206,98 +613,249 @@ class Server:
 
             if online != self.clients[client][2]:
                 self.clients[client][2] = online
+                self.changed("clients", client)
                 self.broadcast_client_info(client)
 
             self.rm_record(id)
+            self.probed(id)
 
     def handle_save(self, id, dest, message):
-        logger.info(f"save message from {dest} received: {message}")
-        src = self.find_client_by_addr(dest)
+        self.logger.info(f"save message from {dest} received: {message}")
+        src = self.find_client_by_addr(dest, id)
         [to, msg] = message.split(" ", maxsplit=1)
 
-        # check the status of the client
-        resp, status_id = make(STATUS)
-        to_cli_addr = (self.clients[to][0], self.clients[to][1])
-        self.sock.sendto(resp, to_cli_addr)
-        self.record(status_id, to_cli_addr, STATUS, "")
+        if to not in self.clients and self.federation.owner(to) is not None:
+            # the owning node checks the status and saves the message
+            self.federation.forward_save(src, dest, id, to, msg)
+        else:
+            self.save_for(src, dest, id, to, msg)
 
-        def callback(from_cli, to_cli, status_id, save_id, dest, msg):
-            self.wait_status(status_id)
+    def save_for(self, src, dest, id, to, msg):
+        # save msg from src to our client to, replying to src @ dest
+        if to not in self.clients:
+            resp, _ = make(NACK_SAVE_MSG, json.dumps(UNKNOWN_USER), id=id)
+            self.sock.sendto(resp, dest)
+            return
 
-            self.mu.acquire()
-            online = self.clients[to_cli][2]
+        # check the status of the client first
+        def then():
+            online = self.clients[to][2]
 
             if online:
                 resp, _ = make(NACK_SAVE_MSG,
-                               json.dumps(self.clients),
-                               id=save_id)
+                               json.dumps(self.directory_for(src, (to,))),
+                               id=id,
+                               compress=src in self.zlib_clients)
                 self.sock.sendto(resp, dest)
             else:
-                self.save_msg(from_cli, to_cli, msg)
-
-                resp, _ = make(ACK_SAVE_MSG, id=save_id)
+                reason = self.save_msg(src, to, msg)
+
+                if reason is None:
+                    self.history.add(get_ts(), src, to, msg)
+                    resp, _ = make(ACK_SAVE_MSG, id=id)
+                else:
+                    # the NACK of a rejected message carries a reason string
+                    # rather than a peer table
+                    resp, _ = make(NACK_SAVE_MSG,
+                                   json.dumps(reason),
+                                   id=id)
                 self.sock.sendto(resp, dest)
-            self.mu.release()
 
-        Thread(target=callback,
-               args=(src, to, status_id, id, dest, msg),
-               daemon=True).start()
+        self.probe(to, then)
 
-    def handle_broadcast_msg(self, id, dest, info):
-        src = self.find_client_by_addr(dest)
+    def handle_broadcast_msg(self, id, dest, raw):
+        src = self.find_client_by_addr(dest, id)
+        info = str(raw, "utf-8")
         self.logger.info(f"BROADCAST_MSG from {src}: {shorten_msg(info)}")
 
         # send ack to the sender
         resp, _ = make(ACK_BROADCAST_MSG, id=id)
         self.sock.sendto(resp, dest)
 
-        # broadcast
-        for client in list(self.clients):
-            if client != src:
-                self.broadcast_chat(src, client, info)
+        self.history.add(get_ts(), src, CHANNEL, info)
+
+        # broadcast the chat as received, and once to every other node for
+        # its own clients
+        self.fan_out(src, info, chat_payload(src, info, raw))
+        self.federation.forward_broadcast(src, info)
+
+    def fan_out(self, src, chat, payload=None):
+        # deliver a broadcast to every client but src, directly or through
+        # relay trees of the online ones
+        online = []
+
+        for client, [_, _, on] in list(self.clients.items()):
+            if client == src:
+                continue
+            if on and self.relay > 0:
+                online.append(client)
+            else:
+                self.broadcast_chat(src, client, chat, payload)
+
+        for relay, names in split(online, self.relay) if online else []:
+            self.relay_chat(src, chat, relay, names)
+
+    def relay_chat(self, src, chat, relay, names):
+        [ip, port, _] = self.clients[relay]
+        dest = (ip, port)
+        # relays get the addresses of their subtree, they may not have all
+        # of it in their peer tables
+        tree = [[name, *self.clients[name][:2]] for name in names]
+        data = json.dumps([src, chat, tree, self.relay])
+
+        resp, id = make(RELAY_MSG, data, self.new_id(relay))
+        if len(resp) > BUF_SIZE:
+            # too large for a datagram, two trees of half the size instead.
+            # Relays only pass on parts of their tree, and report names
+            # from it, so those fit too
+            if len(names) == 0:
+                self.deliver_directly(src, chat, [relay])
+                return
+
+            members = [relay] + names
+            half = len(members) // 2
+            self.relay_chat(src, chat, members[0], members[1:half])
+            self.relay_chat(src, chat, members[half], members[half + 1:])
+            return
+
+        self.sock.sendto(resp, dest)
+        self.record(id, dest, RELAY_MSG, data,
+                    wait=wait(len(names), self.relay))
+
+        self.logger.info(f"relay message from {src} through {relay} to "
+                         f"{len(names)} more: {shorten_msg(chat)}")
+
+    def deliver_directly(self, src, chat, names):
+        # fall back for the part of a relay tree the chat didn't reach
+        for name in names:
+            if name in self.clients:
+                self.broadcast_chat(src, name, chat)
+
+    def handle_ack_relay(self, id, dest, info):
+        if id not in self.inflight:
+            # timed out already, delivered directly
+            return
+
+        data = self.inflight[id][3]
+        self.rm_record(id)
+
+        [src, chat, tree, _] = json.loads(data)
+        reached = set(json.loads(info))
+        missed = [name for name, _, _ in tree if name not in reached]
+
+        if len(missed) > 0:
+            self.logger.info(f"relay tree missed {len(missed)} clients, "
+                             f"delivering directly")
+            self.deliver_directly(src, chat, missed)
+
+    def timeout_relay_msg(self, id, dest, info):
+        [src, chat, tree, _] = json.loads(info)
+        relay = self.find_client_by_addr(dest, id)
+
+        self.logger.info(f"relay {relay} did not report, delivering "
+                         f"directly to its {len(tree) + 1} clients")
+        self.deliver_directly(src, chat, [relay] + [n for n, _, _ in tree])
 
     def handle_ack_broadcast_msg(self, id, dest, info):
         self.rm_record(id)
 
-    # All timeout handlers are called with lock held
-    def timeout_broadcast_msg(self, id, dest, info):
-        resp, id = make(STATUS)
+    def handle_chat_copy(self, id, dest, info):
+        # a client's copy of a direct chat its peer acked
+        src = self.find_client_by_addr(dest, id)
+        [to, msg] = info.split(" ", maxsplit=1)
+
+        if src is not None:
+            self.history.add(get_ts(), src, to, msg)
+
+    def send_history(self, id, dest, client, msgs, cursor):
+        # send a page of results, dropping the oldest until it fits
+        while True:
+            data = json.dumps({"msgs": msgs, "next": cursor})
+            resp, _ = make(HISTORY_RESULT,
+                           data,
+                           id=id,
+                           compress=client in self.zlib_clients)
+            if len(resp) <= BUF_SIZE or len(msgs) == 0:
+                break
+            # the next page starts with the dropped message
+            cursor = msgs.pop(0)[0] + 1
+
         self.sock.sendto(resp, dest)
-        self.record(id, dest, STATUS, "")
 
-        def callback(id, dest, info):
-            self.wait_status(id)
+    def handle_history(self, id, dest, info):
+        client = self.find_client_by_addr(dest, id)
+        if client is None:
+            return
+
+        [peer, cursor] = json.loads(info)
+
+        msgs, cursor = self.history.conversation(client, peer, cursor)
+        self.logger.info(f"history of {client} with {peer}: {len(msgs)} msgs")
+        self.send_history(id, dest, client, msgs, cursor)
+
+    def handle_search(self, id, dest, info):
+        client = self.find_client_by_addr(dest, id)
+        if client is None:
+            return
+
+        [text, cursor] = json.loads(info)
+
+        msgs, cursor = self.history.search(client, text, cursor)
+        self.logger.info(f"search of {client} for {text}: {len(msgs)} msgs")
+        self.send_history(id, dest, client, msgs, cursor)
+
+    def handle_repl_subscribe(self, id, dest, info):
+        self.replicator.subscribe(dest)
+
+    def handle_repl_log(self, id, dest, info):
+        if self.standby is not None:
+            self.standby.handle_log(id, dest, info)
+
+    def handle_ack_node(self, id, dest, info):
+        if self.federation.known(dest, ACK_NODE):
+            self.federation.ack(id)
+
+    def handle_ack_repl(self, id, dest, info):
+        if id in self.inflight:
+            self.replicator.ack(dest, self.inflight[id][3])
+            self.rm_record(id)
+
+    # All timeout handlers are called with lock held
+    def timeout_broadcast_msg(self, id, dest, info):
+        to_cli = self.find_client_by_addr(dest, id)
 
+        def then():
             # we now know the status of the client @ dest
             # we now broacast_chat (save if client offline, otherwise broadcast)
-            self.mu.acquire()
-            to_cli = self.find_client_by_addr(dest)
             [from_cli, chat] = info.split(" ", maxsplit=1)
 
             self.broadcast_chat(from_cli, to_cli, chat)
-            self.mu.release()
 
-        # use a separate thread to perform actions
-        # after status is acked or timed out
-        Thread(target=callback, args=(id, dest, info), daemon=True).start()
+        self.probe(to_cli, then)
 
     def timeout_status(self, id, dest, info):
         # update client status, broadcast updated status
-        client = self.find_client_by_addr(dest)
+        client = self.find_client_by_addr(dest, id)
         prev_status = self.clients[client][2]
         self.logger.info(
             f"The client {client} didn't ack STATUS in time (500ms).")
 
         if prev_status:
             self.clients[client][2] = False
+            self.changed("clients", client)
             self.broadcast_client_info(client)
 
-    def timeout(self):
-        while not self.done:
-            now = get_ts()
+        self.probed(id)
+
+    def timeout_repl_log(self, id, dest, info):
+        self.replicator.resend(dest, info)
 
-            self.mu.acquire()
+    def timeout_node_msg(self, id, dest, info):
+        self.federation.resend(id, dest, info)
 
+    def check_timeouts(self, now):
+        self.mu.acquire()
+        try:
             for id in list(self.inflight):
                 (ts, addr, typ, data) = self.inflight[id]
                 has_timeout = timeout(ts, now)
@@ -306,24 +864,108 @@ class Server:
                     self.logger.info(
                         f"Message {id} timed out, dispatching timeout handler")
 
-                    self.timeout_handlers[typ](id, addr, data)
+                    # removed first, the handler may resend under the same id
                     del self.inflight[id]
-
+                    self.changed("inflight", id)
+                    self.dispatch("timeout", self.timeout_handlers, typ, id,
+                                  addr, data)
+
+            # a standby's msg_store is the primary's to expire
+            if self.standby is None:
+                self.store.sweep(now)
+        finally:
             self.mu.release()
 
+        self.limiter.prune(now)
+
+    def timeout(self):
+        while not self.done:
+            self.check_timeouts(get_ts())
             time.sleep(TIMEOUT / 1000)
 
+    def restore_state(self):
+        start = time.time()
+        state = load(self.checkpointer.path)
+        now = get_ts()
+
+        self.clients = state["clients"]
+        self.msg_store = {
+            dest: [tuple(record) for record in records]
+            for dest, records in state["msg_store"].items()
+        }
+        self.store.rebuild()
+        self.negotiated = state["negotiated"]
+        for name, options in self.negotiated.items():
+            self.apply_options(name, options)
+
+        # resume pending retransmissions. STATUS probes are not resumed,
+        # whoever was waiting on them is gone
+        resumed = 0
+        for id, (ts, addr, typ, data) in state["inflight"].items():
+            addr = tuple(addr)
+
+            if typ == BROADCAST_MSG:
+                resp, _ = make(BROADCAST_MSG, data, id=id)
+                self.sock.sendto(resp, addr)
+                self.inflight[id] = (now, addr, typ, data)
+                resumed += 1
+            else:
+                self.changed("inflight", id)
+
+            if typ == RELAY_MSG:
+                # whether the tree reported is unknown
+                [src, chat, tree, _] = json.loads(data)
+                relay = self.find_client_by_addr(addr, id)
+                self.deliver_directly(src, chat,
+                                      [relay] + [n for n, _, _ in tree])
+
+        records = len(self.clients) + len(self.msg_store) + resumed
+        self.checkpointer.lines = self.checkpointer.live = records
+
+        self.logger.info(
+            f"restored {len(self.clients)} clients, "
+            f"{sum(map(len, self.msg_store.values()))} saved messages and "
+            f"resumed {resumed} retransmissions from "
+            f"{self.checkpointer.path} ({int((time.time() - start) * 1000)}ms)"
+        )
+
     def stop(self):
         self.done = True
         self.sock.close()
+        if self.checkpointer is not None:
+            self.checkpointer.flush()
+        if self.profiler.enabled:
+            self.profiler.stop()
         self.logger.info("server gracefully exited")
 
     def start(self):
-        # bind to a UDP socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(("", self.port))
-
-        self.logger.info(f"created UDP socket, bound to port {self.port}")
+        # bind to a UDP port, or a Unix-domain socket path
+        self.sock = bind(self.port)
+        if self.rcvbuf is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                 self.rcvbuf)
+        if self.sndbuf is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                 self.sndbuf)
+
+        self.logger.info(f"created socket, bound to {self.port}")
+
+        if self.trace is not None:
+            self.sock = TracingSocket(self.sock, self.trace)
+            self.logger.info(f"recording datagrams to {self.trace}")
+
+        if self.egress:
+            self.sock = EgressSocket(self.sock)
+            self.profiler.reports.append(self.sock.report)
+
+        if self.restore:
+            self.restore_state()
+
+        if self.profile:
+            self.profiler.start()
+        # toggles profiling, dumping what was collected when turned off
+        if hasattr(signal, "SIGUSR1") and current_thread() is main_thread():
+            signal.signal(signal.SIGUSR1, self.profiler.toggle)
 
         listener = Thread(target=self.handle_requests,
                           name="req_handler",
@@ -333,6 +975,20 @@ class Server:
         listener.start()
         timeout.start()
 
+        if self.checkpointer is not None:
+            Thread(target=self.checkpointer.run,
+                   name="checkpoint",
+                   daemon=True).start()
+
+        Thread(target=self.replicator.run, name="replicator",
+               daemon=True).start()
+        Thread(target=self.federation.run, name="federation",
+               daemon=True).start()
+
+        if self.standby is not None:
+            Thread(target=self.standby.run, name="standby",
+                   daemon=True).start()
+
         try:
             listener.join()
             timeout.join()
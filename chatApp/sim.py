@@ -0,0 +1,328 @@
+#
+# Simulated network for servers and clients, run a scenario with:
+#
+#   python -m chatApp.sim [clients=1000] [hours=1.0] [seed=0] [loss=0] ...
+#
+# Datagrams are delivered in memory after a latency plus jitter, or lost,
+# duplicated or held back (reordered), and time is a virtual clock that
+# jumps from one event to the next. Everything random, message ids
+# included, is drawn from one generator, so a scenario runs much faster
+# than its simulated time and reproduces exactly from its seed: the digest
+# of every datagram delivered is the same on each run.
+#
+# Nodes are driven by events rather than threads: a datagram arriving on
+# a node's socket is handled right away, and the node checks its timeouts
+# every TIMEOUT, a client only while it has requests in flight. Exceptions
+# raised by handlers are counted and the node carries on.
+#
+
+import contextlib
+import hashlib
+import heapq
+import os
+import random
+import sys
+import time
+import uuid
+from collections import deque, Counter
+
+from . import message
+from .message import *
+from .server import Server
+from .client import Client
+from .bench import quiet_logger
+from .constant import BUF_SIZE, TIMEOUT
+
+START = 1704067200.0  # virtual time of the start of a simulation
+HOST = "127.0.0.1"
+
+
+class VirtualClock:
+
+    def __init__(self, rng, start=START):
+        self.rng = rng
+        self.ts = start
+
+    def now(self):
+        return self.ts
+
+    def uuid(self):
+        # message ids, from the seeded generator rather than the OS
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+
+class SimSocket:
+    # stands in for the UDP socket of a node
+
+    def __init__(self, net, addr, handle):
+        self.net = net
+        self.addr = addr
+        self.handle = handle  # called when a datagram arrived
+        self.queue = deque()  # (datagram, source addr)
+        self.closed = False
+
+    def sendto(self, data, addr):
+        self.net.transmit(self.addr, bytes(data), tuple(addr))
+        return len(data)
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        return self.sendto(b"".join(buffers), addr)
+
+    def recvfrom_into(self, buf, nbytes=0, flags=0):
+        if len(self.queue) == 0:
+            raise BlockingIOError
+        data, addr = self.queue.popleft()
+        n = min(len(data), len(buf))
+        buf[:n] = data[:n]
+        return n, addr
+
+    def close(self):
+        self.closed = True
+
+
+class SimNetwork:
+
+    def __init__(self,
+                 seed=0,
+                 latency=0.01,
+                 jitter=0.005,
+                 loss=0.0,
+                 duplicate=0.0,
+                 reorder=0.0):
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock(self.rng)
+        self.latency = latency  # seconds
+        self.jitter = jitter  # seconds, added at random to the latency
+        self.loss = loss  # probabilities per datagram
+        self.duplicate = duplicate
+        self.reorder = reorder  # held back up to 4 latencies
+        self.events = []  # heap of (time, seq, callback, args)
+        self.seq = 0
+        self.sockets = dict()  # addr -> SimSocket
+        self.armed = set()  # clients with a timeout check scheduled
+        self.stats = Counter()
+        self.types = Counter()  # message type -> datagrams delivered
+        self.errors = Counter()  # exception -> times raised by handlers
+        self.digest = hashlib.sha256()
+
+    def at(self, ts, callback, *args):
+        heapq.heappush(self.events, (ts, self.seq, callback, args))
+        self.seq += 1
+
+    def after(self, delay, callback, *args):
+        self.at(self.clock.ts + delay, callback, *args)
+
+    def transmit(self, src, data, dest):
+        self.stats["sent"] += 1
+        if self.rng.random() < self.loss:
+            self.stats["lost"] += 1
+            return
+
+        copies = 1
+        if self.rng.random() < self.duplicate:
+            self.stats["duplicated"] += 1
+            copies = 2
+
+        for _ in range(copies):
+            delay = self.latency + self.rng.random() * self.jitter
+            if self.rng.random() < self.reorder:
+                # datagrams sent after it overtake it
+                self.stats["reordered"] += 1
+                delay += self.rng.random() * 4 * self.latency
+            self.after(delay, self.deliver, src, data, dest)
+
+    def deliver(self, src, data, dest):
+        sock = self.sockets.get(dest)
+        if sock is None or sock.closed:
+            self.stats["unreachable"] += 1
+            return
+
+        self.stats["delivered"] += 1
+        self.types[msg_type(int(data[:data.find(b" ")].rstrip(b"z")))] += 1
+        self.digest.update(
+            f"{self.clock.ts!r} {src} {dest} {len(data)} ".encode() + data)
+
+        sock.queue.append((data, src))
+        sock.handle()
+
+    def guard(self, fn, *args):
+        # runs a node's code, counting what it raised instead of stopping
+        try:
+            fn(*args)
+        except SystemExit:
+            # a client gave up on the server and stopped
+            self.stats["exited"] += 1
+        except Exception as e:
+            self.errors[f"{type(e).__name__} in {fn.__name__}: {e}"] += 1
+
+    def add_server(self, port, **options):
+        server = Server(port, logger=quiet_logger(), **options)
+        server.sock = SimSocket(self, (HOST, port),
+                                lambda: self.guard(server.handle_batch))
+        self.sockets[server.sock.addr] = server.sock
+        self.after(TIMEOUT / 1000, self.tick_server, server)
+        return server
+
+    def tick_server(self, server):
+        if not server.done:
+            self.guard(server.check_timeouts, self.clock.ts)
+            self.after(TIMEOUT / 1000, self.tick_server, server)
+
+    def add_client(self, name, port, server_port, **options):
+        client = Client(name, HOST, server_port, port, logger=quiet_logger(),
+                        **options)
+        buf = bytearray(BUF_SIZE)
+
+        def handle():
+            while len(client.sock.queue) > 0 and not client.done:
+                n, addr = client.sock.recvfrom_into(buf)
+                self.guard(client.handle_datagram, buf, n, addr)
+            self.arm(client)
+
+        client.sock = SimSocket(self, (HOST, port), handle)
+        self.sockets[client.sock.addr] = client.sock
+        return client
+
+    def act(self, client, fn, *args):
+        # client does something, as if typed in
+        if not client.done:
+            self.guard(fn, *args)
+            self.arm(client)
+
+    def arm(self, client):
+        if len(client.inflight) > 0 and client not in self.armed:
+            self.armed.add(client)
+            self.after(TIMEOUT / 1000, self.tick_client, client)
+
+    def tick_client(self, client):
+        self.armed.discard(client)
+        if not client.done:
+            self.guard(client.check_timeouts, self.clock.ts)
+            self.arm(client)
+
+    def run(self, seconds):
+        # runs the events of the next seconds of virtual time, with the
+        # virtual clock in place of the real one
+        until = self.clock.ts + seconds
+        real, message.clock = message.clock, self.clock
+
+        try:
+            with open(os.devnull, "w") as null, \
+                    contextlib.redirect_stdout(null):
+                while len(self.events) > 0 and self.events[0][0] <= until:
+                    ts, _, callback, args = heapq.heappop(self.events)
+                    self.clock.ts = ts
+                    callback(*args)
+            self.clock.ts = until
+        finally:
+            message.clock = real
+
+
+def scenario(clients=1000,
+             hours=1.0,
+             seed=0,
+             loss=0.0,
+             duplicate=0.0,
+             reorder=0.0,
+             latency=0.01,
+             jitter=0.005,
+             contacts=20,
+             think=600,
+             away=0.1,
+             broadcasts=2.0,
+             port=5000):
+    # clients register during the first minute with a few contacts each,
+    # then every think seconds on average chat to a contact, or someone
+    # else (looked up), or go away for a while; broadcasts are per hour
+    # across all clients
+    net = SimNetwork(seed, latency, jitter, loss, duplicate, reorder)
+    rng = random.Random(seed + 1)  # the scenario's own, apart from net's
+    server = net.add_server(port)
+    names = [f"user{i}" for i in range(clients)]
+    contacts = min(contacts, clients)
+    group = []
+    actions = Counter()
+
+    for i, name in enumerate(names):
+        client = net.add_client(name,
+                                port + 1 + i,
+                                port,
+                                contacts=rng.sample(names, contacts),
+                                lookup=True)
+        group.append(client)
+        net.after(rng.random() * 60, net.act, client, client.register)
+        net.after(60 + rng.expovariate(1 / think), step, net, rng, client,
+                  names, think, away, actions)
+
+    for _ in range(int(broadcasts * hours)):
+        client = rng.choice(group)
+        net.after(60 + rng.random() * (hours * 3600 - 60), net.act, client,
+                  client.send_all, "hello everyone")
+        actions["broadcast"] += 1
+
+    return net, server, group, actions
+
+
+def step(net, rng, client, names, think, away, actions):
+    # the next action of client, then schedules the one after
+    online = client.username in client.peers and \
+        client.peers[client.username][2]
+    r = rng.random()
+
+    if not online:
+        actions["register"] += 1
+        net.act(client, client.register)
+    elif r < away:
+        actions["deregister"] += 1
+        net.act(client, client.deregister, client.username)
+    elif r < away + (1 - away) * 0.9:
+        actions["chat to contact"] += 1
+        peer = rng.choice(sorted(client.interests))
+        net.act(client, client.send_chat, peer, f"hi {peer}")
+    else:
+        actions["chat to stranger"] += 1
+        peer = rng.choice(names)
+        net.act(client, client.send_chat, peer, f"hi {peer}")
+
+    net.after(rng.expovariate(1 / think), step, net, rng, client, names,
+              think, away, actions)
+
+
+def main():
+    options = dict()
+    defaults = scenario.__defaults__
+    params = scenario.__code__.co_varnames[:len(defaults)]
+
+    for arg in sys.argv[1:]:
+        name, _, value = arg.partition("=")
+        if name not in params:
+            usage = " ".join(f"[{p}={d}]" for p, d in zip(params, defaults))
+            print(f"Usage: python -m chatApp.sim {usage}")
+            sys.exit(1)
+        options[name] = type(defaults[params.index(name)])(value)
+
+    start = time.perf_counter()
+    net, server, group, actions = scenario(**options)
+    hours = options.get("hours", 1)
+    net.run(hours * 3600)
+    elapsed = time.perf_counter() - start
+
+    print(f"simulated {hours}h of {len(group)} clients in {elapsed:.1f}s "
+          f"({hours * 3600 / elapsed:.0f}x real time)")
+    print("actions: " + ", ".join(f"{n} {k}" for k, n in
+                                  sorted(actions.items())))
+    print("datagrams: " + ", ".join(f"{n} {k}" for k, n in
+                                    net.stats.most_common()))
+    print("delivered: " + ", ".join(f"{n} {k}" for k, n in
+                                    net.types.most_common()))
+    online = sum(1 for _, _, on in server.clients.values() if on)
+    print(f"server: {online}/{len(server.clients)} clients online, "
+          f"{server.store.count} messages stored, "
+          f"{len(server.inflight)} in flight")
+    for error, n in (net.errors + server.errors).most_common():
+        print(f"error x{n}: {error}")
+    print(f"digest {net.digest.hexdigest()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#
+# Limits on the offline messages the server keeps in msg_store: a cap on
+# the count and bytes of the messages queued for each recipient, a budget
+# for all of them, and a time to live
+#
+# The messages of a recipient are in save order and only ever removed from
+# the front, so its oldest is always first. A FIFO of (save time,
+# recipient) over all recipients finds the oldest message overall, for the
+# budget and for expiry. Its entries of messages already gone (delivered or
+# evicted) are skipped when reached, and it is rebuilt once they make up
+# most of it.
+#
+
+from collections import deque
+
+from .constant import (STORE_MAX_MSGS, STORE_MAX_BYTES, STORE_BUDGET,
+                       STORE_TTL, SWEEP_BATCH)
+
+DROP_OLDEST = "drop-oldest"
+REJECT = "reject"
+POLICIES = (DROP_OLDEST, REJECT)
+
+# NACK_SAVE_MSG reasons
+TOO_LARGE = "message too large"
+QUEUE_FULL = "recipient's queue full"
+STORE_FULL = "server storage full"
+UNKNOWN_USER = "no such user"
+
+
+def size(record):
+    return len(record[2].encode())
+
+
+class StoreQuota:
+
+    def __init__(self,
+                 server,
+                 max_msgs=STORE_MAX_MSGS,
+                 max_bytes=STORE_MAX_BYTES,
+                 budget=STORE_BUDGET,
+                 ttl=STORE_TTL,
+                 policy=DROP_OLDEST):
+        self.server = server
+        self.max_msgs = max_msgs
+        self.max_bytes = max_bytes
+        self.budget = budget
+        self.ttl = ttl
+        self.policy = policy
+        self.sizes = dict()  # recipient -> bytes queued
+        self.count = 0
+        self.total = 0
+        self.order = deque()  # (save time, recipient), oldest first
+        self.evicted = 0
+        self.expired = 0
+        self.rejected = 0
+
+    def rebuild(self):
+        # recount msg_store, after it was restored or replicated
+        store = self.server.msg_store
+        self.sizes = {
+            dest: sum(map(size, records))
+            for dest, records in store.items()
+        }
+        self.count = sum(map(len, store.values()))
+        self.total = sum(self.sizes.values())
+        self.order = deque(
+            sorted((record[0], dest) for dest, records in store.items()
+                   for record in records))
+
+    # all below must be called with server.mu held
+
+    def admit(self, dest, msg):
+        # makes room for msg to be saved for dest, returns why it can't be
+        # or None
+        n = len(msg.encode())
+        queued = len(self.server.msg_store.get(dest, []))
+
+        if n > self.max_bytes or n > self.budget:
+            reason = TOO_LARGE
+        elif self.policy == REJECT:
+            if queued >= self.max_msgs or \
+                    self.sizes.get(dest, 0) + n > self.max_bytes:
+                reason = QUEUE_FULL
+            elif self.total + n > self.budget:
+                reason = STORE_FULL
+            else:
+                reason = None
+        else:
+            while queued >= self.max_msgs or \
+                    self.sizes.get(dest, 0) + n > self.max_bytes:
+                if queued == 0:
+                    # a cap of no messages, nothing to make room with
+                    self.rejected += 1
+                    return QUEUE_FULL
+                self.drop(dest)
+                self.evicted += 1
+                queued -= 1
+
+            while self.total + n > self.budget and self.drop_oldest():
+                self.evicted += 1
+
+            reason = None
+
+        if reason is not None:
+            self.rejected += 1
+        return reason
+
+    def added(self, dest, record):
+        self.sizes[dest] = self.sizes.get(dest, 0) + size(record)
+        self.count += 1
+        self.total += size(record)
+        self.order.append((record[0], dest))
+
+    def removed(self, dest, records):
+        n = sum(map(size, records))
+        self.count -= len(records)
+        self.total -= n
+        if dest in self.sizes:
+            self.sizes[dest] -= n
+            if len(self.server.msg_store.get(dest, [])) == 0:
+                del self.sizes[dest]
+
+    def drop(self, dest):
+        # drops the oldest message queued for dest
+        store = self.server.msg_store
+        record = store[dest].pop(0)
+
+        if len(store[dest]) == 0:
+            del store[dest]
+        self.removed(dest, [record])
+        self.server.changed("msg_store", dest)
+
+    def drop_oldest(self, before=None):
+        # drops the oldest message queued for anyone (if saved before),
+        # returns whether there was one
+        store = self.server.msg_store
+
+        while len(self.order) > 0:
+            ts, dest = self.order[0]
+            if before is not None and ts >= before:
+                return False
+
+            self.order.popleft()
+            # gone already unless still first in its queue
+            if dest in store and store[dest][0][0] <= ts:
+                self.drop(dest)
+                return True
+
+        return False
+
+    def sweep(self, now):
+        # expires messages older than the ttl, a bounded number per call
+        for _ in range(SWEEP_BATCH):
+            if not self.drop_oldest(before=now - self.ttl):
+                break
+            self.expired += 1
+
+        if len(self.order) > 2 * self.count + SWEEP_BATCH:
+            self.order = deque(entry for entry in self.order
+                               if self.live(entry))
+
+    def live(self, entry):
+        ts, dest = entry
+        records = self.server.msg_store.get(dest, [])
+        return len(records) > 0 and records[0][0] <= ts
@@ -0,0 +1,103 @@
+#
+# Recording of sent and received datagrams to a compact binary trace file
+#
+# The file starts with MAGIC, followed by one record per datagram: a HEADER
+# (timestamp, direction, length of the address, length of the datagram),
+# the address as "host:port" and the datagram itself.
+#
+
+import struct
+import time
+from threading import Lock
+
+MAGIC = b"CHATTRACE1\n"
+HEADER = struct.Struct("<dBBH")
+
+RECV = 0
+SEND = 1
+
+
+def format_addr(addr):
+    return f"{addr[0]}:{addr[1]}"
+
+
+def parse_addr(addr):
+    host, port = addr.rsplit(":", 1)
+    return host, int(port)
+
+
+class TracingSocket:
+    # wraps a socket, recording every datagram sent or received
+
+    def __init__(self, sock, path):
+        self.sock = sock
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.flushed = time.time()
+        self.mu = Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def write(self, direction, addr, data):
+        addr = format_addr(addr).encode()
+        now = time.time()
+
+        self.mu.acquire()
+        self.file.write(HEADER.pack(now, direction, len(addr), len(data)))
+        self.file.write(addr)
+        self.file.write(data)
+
+        # buffered, but not for long in case the process is killed
+        if now - self.flushed > 1:
+            self.file.flush()
+            self.flushed = now
+        self.mu.release()
+
+    def sendto(self, data, addr):
+        n = self.sock.sendto(data, addr)
+        self.write(SEND, addr, data)
+        return n
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        n = self.sock.sendmsg(buffers, ancdata, flags, addr)
+        self.write(SEND, addr, b"".join(buffers))
+        return n
+
+    def recvfrom(self, bufsize, *args):
+        data, addr = self.sock.recvfrom(bufsize, *args)
+        self.write(RECV, addr, data)
+        return data, addr
+
+    def recvfrom_into(self, buf, *args):
+        n, addr = self.sock.recvfrom_into(buf, *args)
+        self.write(RECV, addr, bytes(buf[:n]))
+        return n, addr
+
+    def close(self):
+        self.mu.acquire()
+        self.file.close()
+        self.mu.release()
+        self.sock.close()
+
+
+def read(path):
+    # yields (timestamp, direction, (host, port), datagram)
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a chatApp trace")
+
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+
+            ts, direction, addr_len, data_len = HEADER.unpack(header)
+            addr = f.read(addr_len).decode()
+            data = f.read(data_len)
+
+            if len(data) < data_len:
+                # the recorder was killed mid-write
+                return
+
+            yield ts, direction, parse_addr(addr), data
@@ -0,0 +1,112 @@
+#
+# Transports under the server and clients: UDP, or Unix-domain datagram
+# sockets for nodes on the same host, picked by the scheme of the endpoint
+# a node binds to, a port or "unix:<path>"
+#
+# To the rest of the code a Unix-domain address is (path, 0), standing in
+# for (ip, port), so peer and client tables, handlers and failover work
+# unchanged. A node talks over one transport: a server bound to a socket
+# path only reaches, and is only reached by, nodes bound to one too.
+#
+# Datagrams sent on a Unix-domain socket are never lost, a send blocks
+# while the receiver's queue is full and fails when nobody is bound to the
+# path. Sends don't block here and such datagrams are dropped instead, as
+# they would be over UDP, so a stalled or gone peer can't hold up a node.
+#
+
+import os
+import socket
+import stat
+
+UNIX = "unix:"
+
+# what a datagram sent to a peer not keeping up, or gone, raises
+DROPPED = (BlockingIOError, FileNotFoundError, ConnectionRefusedError)
+
+
+def is_unix(endpoint):
+    return type(endpoint) == str and endpoint.startswith(UNIX)
+
+
+def unix_addr(endpoint):
+    # "unix:<path>" -> (path, 0)
+    return endpoint[len(UNIX):], 0
+
+
+def resolve(addr):
+    # a configured (host, port) as sources are seen by recvfrom, with the
+    # host's address in place of its name
+    if addr[1] == 0:
+        # a socket path
+        return addr
+    return socket.gethostbyname(addr[0]), addr[1]
+
+
+def label(endpoint):
+    # endpoint in file names, the port or the socket file's name
+    if is_unix(endpoint):
+        return os.path.basename(unix_addr(endpoint)[0])
+    return str(endpoint)
+
+
+class UnixSocket:
+    # an AF_UNIX SOCK_DGRAM socket, addressed with (path, 0)
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.path = None
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def bind(self, addr):
+        path = addr[0]
+        # left behind by a node that didn't exit cleanly
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+
+        self.sock.bind(path)
+        self.path = path
+
+    def sendto(self, data, addr):
+        try:
+            return self.sock.sendto(data, socket.MSG_DONTWAIT, addr[0])
+        except DROPPED:
+            return 0
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        try:
+            return self.sock.sendmsg(buffers, ancdata,
+                                     flags | socket.MSG_DONTWAIT, addr[0])
+        except DROPPED:
+            return 0
+
+    def recvfrom_into(self, buf, nbytes=0, flags=0):
+        n, path = self.sock.recvfrom_into(buf, nbytes, flags)
+        # an unbound sender has no path, and can't be answered
+        return n, (path or "", 0)
+
+    def recvfrom(self, bufsize, flags=0):
+        data, path = self.sock.recvfrom(bufsize, flags)
+        return data, (path or "", 0)
+
+    def getsockname(self):
+        return self.path, 0
+
+    def close(self):
+        self.sock.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+            self.path = None
+
+
+def bind(endpoint, host=""):
+    # a socket bound to endpoint, a UDP port on host or "unix:<path>"
+    if is_unix(endpoint):
+        sock = UnixSocket()
+        sock.bind(unix_addr(endpoint))
+        return sock
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, endpoint))
+    return sock